@@ -6,7 +6,7 @@ import base64
 import time
 import random
 
-import requests
+import API.oobaooga_api
 import sseclient
 
 import main
@@ -174,7 +174,7 @@ def run(user_input, temp_level):
         'preset': preset
     }
 
-    response = requests.post(URI, headers=headers, json=request, verify=False)
+    response = API.oobaooga_api.post_request(URI, request)
 
 
     if response.status_code == 200:
@@ -356,7 +356,7 @@ def run_streaming(user_input, temp_level):
 
     # Actual streaming bit
 
-    stream_response = requests.post(URI, headers=headers, json=request, verify=False, stream=True)
+    stream_response = API.oobaooga_api.post_request(URI, request, stream=True)
     client = sseclient.SSEClient(stream_response)
 
     # Clear streamed emote list
@@ -797,7 +797,7 @@ def summary_memory_run(messages_input, user_sent_message):
         'preset': preset
     }
 
-    response = requests.post(URI, headers=headers, json=request, verify=False)
+    response = API.oobaooga_api.post_request(URI, request)
 
     if response.status_code == 200:
         received_message = response.json()['choices'][0]['message']['content']
@@ -999,7 +999,7 @@ def view_image(direct_talk_transcript):
             'preset': VISUAL_PRESET_NAME
         }
 
-        response = requests.post(IMG_URI, json=request)
+        response = API.oobaooga_api.post_request(IMG_URI, request)
         received_cam_message = response.json()['choices'][0]['message']['content']
 
         # Translate issues with the received message
@@ -1150,7 +1150,7 @@ def view_image_streaming(direct_talk_transcript):
 
         # Actual streaming bit
 
-        stream_response = requests.post(IMG_URI, headers=headers, json=request, verify=False, stream=True)
+        stream_response = API.oobaooga_api.post_request(IMG_URI, request, stream=True)
         client = sseclient.SSEClient(stream_response)
 
         # Clear streamed emote list
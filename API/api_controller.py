@@ -1,3 +1,4 @@
+import atexit
 import copy
 import datetime
 import os
@@ -6,8 +7,9 @@ import json
 import base64
 import time
 import random
+import shutil
+import hashlib
 
-import requests
 import sseclient
 
 import main
@@ -17,6 +19,8 @@ import utils.zw_logging
 from dotenv import load_dotenv
 import utils.settings
 import utils.retrospect
+import utils.rag_summaries
+import utils.rag_recency
 import utils.lorebook
 import utils.tag_task_controller
 import colorama
@@ -63,8 +67,30 @@ API_TYPE_VISUAL = os.environ.get("API_TYPE_VISUAL")
 
 history_loaded = False
 
+# The chat history. This is the real one, kept in memory; LiveLog.json just gets written out from it in the background
 ooga_history = [ ["Hello, I am back!", "Welcome back! *smiles*"] ]
 
+# Background saving. Saves just flag the history to be written out, and ones that come in close together get written
+# out as one (after waiting this long, in seconds)
+history_save_event = threading.Event()
+history_write_lock = threading.Lock()
+history_writer_thread = None
+history_save_delay = 0.5
+
+# Chat journal. Rather than writing out the whole history every message, each change (a pair added, popped, or deleted)
+# gets appended to the journal as one JSON line. Every 8 changes it all gets folded (compacted) into LiveLog.json, same
+# as the old backup cadence, and after a minute with nothing new, and on closing. So LiveLog.json is never far behind
+history_journal_file = "LiveLog_Journal.jsonl"
+history_journal_records = []            # Changes not written to the journal yet
+history_journal_lock = threading.Lock()
+history_journal_count = 0               # Changes in the journal file
+history_journal_compact_limit = 8
+history_journal_compact_interval = 60   # Seconds
+
+# Fingerprint (SHA-256) of LiveLog.json as it is on disk. The journal starts with the one it goes on top of, so it only
+# ever gets replayed onto that exact file (not again onto one it was already folded into)
+history_journal_base = None
+
 headers = {
     "Content-Type": "application/json"
 }
@@ -72,6 +98,17 @@ headers = {
 max_context = int(os.environ.get("TOKEN_LIMIT"))
 marker_length = int(os.environ.get("MESSAGE_PAIR_LIMIT"))
 
+# How the prompt gets laid out. "Classic" slides the history along a pair each message, with the lore, RAG and time
+# mixed in a few back. "Cached" keeps the start of the prompt the same between turns, so the LLM server can reuse its
+# prompt cache; the history only moves along a block of pairs at a time, and everything that changes goes at the end
+prompt_layout = os.environ.get("PROMPT_LAYOUT", "Classic")
+prompt_cache_block = max(int(os.environ.get("PROMPT_CACHE_BLOCK", "8")), 1)
+
+# The last prompt sent with the cached layout, and where its history started, to check the next one builds on it. LM
+# Studio also keeps its chat for this prompt, and only adds the new messages on for the next one
+last_cached_prompt = []
+last_cached_window_start = 0
+
 force_token_count = False
 forced_token_level = 120
 
@@ -132,10 +169,7 @@ def run(user_input, temp_level):
     # Did the last message we got contain our name?
     check_for_name_in_message(user_input)
 
-    # Load the history from JSON, to clean up the quotation marks
-    #
-    with open("LiveLog.json", 'r') as openfile:
-        ooga_history = json.load(openfile)
+    # NOTE: The history in memory is the real one, and gets cleaned up as messages go in, so no need to load it again
 
 
     # Determine what preset we want to load in with
@@ -258,7 +292,7 @@ def run(user_input, temp_level):
     log_user_input = "{0}".format(user_input)
     log_received_message = "{0}".format(received_message)
 
-    ooga_history.append([log_user_input, log_received_message, utils.tag_task_controller.apply_tags(), "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+    add_to_history([log_user_input, log_received_message, utils.tag_task_controller.apply_tags(), "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
     # Run a pruning of the deletables
     prune_deletables()
@@ -308,10 +342,7 @@ def run_streaming(user_input, temp_level):
     # Did the last message we got contain our name?
     check_for_name_in_message(user_input)
 
-    # Load the history from JSON, to clean up the quotation marks
-    #
-    with open("LiveLog.json", 'r') as openfile:
-        ooga_history = json.load(openfile)
+    # NOTE: The history in memory is the real one, and gets cleaned up as messages go in, so no need to load it again
 
 
     # Determine what preset we want to load in with
@@ -400,7 +431,7 @@ def run_streaming(user_input, temp_level):
         }
 
         # Actual streaming bit
-        stream_response = requests.post(URI, headers=headers, json=request, verify=False, stream=True)
+        stream_response = API.oobaooga_api.post_request(URI, request, stream=True)
         client = sseclient.SSEClient(stream_response)
 
         streamed_api_stringpuller = client.events()
@@ -455,8 +486,8 @@ def run_streaming(user_input, temp_level):
         # Cut for the hangout name being said
         if streamed_response_check == "Hangout-Name-Cut" and utils.settings.hangout_mode:
             # Add any existing stuff to our actual chat history
-            ooga_history.append([user_input, assistant_message, utils.settings.cur_tags,
-                                 "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+            add_to_history([user_input, assistant_message, utils.settings.cur_tags,
+                            "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
             save_histories()
 
             # Remove flag
@@ -554,7 +585,7 @@ def run_streaming(user_input, temp_level):
     log_user_input = "{0}".format(user_input)
     log_received_message = "{0}".format(received_message)
 
-    ooga_history.append([log_user_input, log_received_message, utils.tag_task_controller.apply_tags(), "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+    add_to_history([log_user_input, log_received_message, utils.tag_task_controller.apply_tags(), "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
     # Run a pruning of the deletables
     prune_deletables()
@@ -627,6 +658,10 @@ def send_via_oogabooga(user_input):
     if utils.settings.rag_enabled:
         utils.based_rag.run_based_rag(user_input, ooga_history[len(ooga_history) - 1][1])
 
+    # Recall any older summaries that are relevant
+    if utils.retrospect.use_rolling_summaries:
+        utils.rag_summaries.run_summary_rag(user_input, ooga_history[len(ooga_history) - 1][1], utils.retrospect.live_summarization_log)
+
     # Run
     if not utils.settings.stream_chats:
         run(user_input, 0)
@@ -661,7 +696,7 @@ def next_message_oogabooga():
     print("Generating Replacement Message!")
     cycle_message = ooga_history[-1][0]
     cycle_tag = ooga_history[-1][2]
-    ooga_history.pop()
+    pop_from_history()
 
     # Save
     save_histories()
@@ -693,7 +728,7 @@ def next_message_oogabooga():
 def undo_message():
     global ooga_history
 
-    ooga_history.pop()
+    pop_from_history()
 
     # Fix the RAG database
     utils.based_rag.remove_latest_database_message()
@@ -703,6 +738,38 @@ def undo_message():
 
 
 
+# Pins the latest message pair (or unpins it, if it already is), so the RAG gives it a boost whenever it comes up.
+# Gives back if it is pinned now
+def toggle_pin_latest():
+
+    with history_journal_lock:
+        if len(ooga_history) == 0:
+            return False
+
+        index = len(ooga_history) - 1
+        tags = []
+        if len(ooga_history[index]) > 2 and isinstance(ooga_history[index][2], list):
+            tags = list(ooga_history[index][2])
+
+        pinned = utils.rag_recency.pinned_tag not in tags
+        if pinned:
+            tags.append(utils.rag_recency.pinned_tag)
+        else:
+            tags.remove(utils.rag_recency.pinned_tag)
+
+        history_journal_records.append({'op': "tags", 'length': len(ooga_history), 'index': index, 'tags': tags})
+        set_history_tags(index, tags)
+        message_pair = ooga_history[index]
+
+    # The RAG usually only takes the pair in on the next message, but it may have it already (like after a restart)
+    utils.based_rag.update_latest_pair_tags(message_pair)
+
+    save_histories()
+
+    return pinned
+
+
+
 def check_load_past_chat():
     global ooga_history
     global history_loaded
@@ -710,10 +777,14 @@ def check_load_past_chat():
 
     if history_loaded == False:
 
-        # Load the history from JSON
+        # Load the history from JSON, then anything that has changed since from the journal
+
+        with open("LiveLog.json", 'rb') as openfile:
+            live_log_bytes = openfile.read()
 
-        with open("LiveLog.json", 'r') as openfile:
-            ooga_history = json.load(openfile)
+        ooga_history = json.loads(live_log_bytes)
+
+        replay_history_journal(hashlib.sha256(live_log_bytes).hexdigest())
 
         history_loaded = True
 
@@ -736,25 +807,207 @@ def check_load_past_chat():
 
 
 
-def save_histories():
+# Adds a message pair to the history, cleaned up as it goes in
+def add_to_history(message_pair):
 
-    # Strip out any quotation marks from the most recent history if we have the setting on
+    # Our own copy, so nothing it came from (like the current tags list) can change it later
+    message_pair = copy.deepcopy(message_pair)
+
+    # Strip out any quotation marks if we have the setting on
     if utils.settings.removal_quotes_from_hist:
         # This targets straight quotes, opening curly quotes, and closing curly quotes
-        cleaned_text = ooga_history[-1][1].replace('"', '').replace('“', '').replace('”', '')
-        ooga_history[-1][1] = cleaned_text
+        message_pair[1] = message_pair[1].replace('"', '').replace('“', '').replace('”', '')
+
+    with history_journal_lock:
+        history_journal_records.append({'op': "add", 'length': len(ooga_history), 'pair': message_pair})
+        ooga_history.append(message_pair)
 
-    # Export to JSON
-    with open("LiveLog.json", 'w') as outfile:
-        json.dump(ooga_history, outfile, indent=4)
 
-    # Save RAG database too
-    utils.based_rag.store_rag_history()
+# Gives a message pair new tags. Swapped for a new pair, as the RAG may share the old one's tags list
+def set_history_tags(index, tags):
+
+    message_pair = list(ooga_history[index])
+    if len(message_pair) > 2:
+        message_pair[2] = tags
+    else:
+        message_pair.append(tags)
 
-    # Make a manual backup every 10 messages
-    if len(ooga_history) % 8 == 0:
-        with open("Backups/LiveLogBackupContinual.bak", 'w') as soutfile:
-            json.dump(ooga_history, soutfile, indent=4)
+    ooga_history[index] = message_pair
+
+
+# Takes the latest message pair off the history
+def pop_from_history():
+
+    with history_journal_lock:
+        history_journal_records.append({'op': "pop", 'length': len(ooga_history)})
+        ooga_history.pop()
+
+
+# Deletes a message pair from the history
+def delete_from_history(index):
+
+    with history_journal_lock:
+        history_journal_records.append({'op': "delete", 'length': len(ooga_history), 'index': index})
+        del ooga_history[index]
+
+
+# Flags the history (and RAG) to be saved. It gets written out in the background, so we never wait on the disk
+def save_histories():
+    global history_writer_thread
+
+    if history_writer_thread is None:
+        history_writer_thread = threading.Thread(target=history_writer_loop)
+        history_writer_thread.daemon = True
+        history_writer_thread.start()
+
+    history_save_event.set()
+
+
+def history_writer_loop():
+
+    while True:
+
+        # Nothing new for a while, fold in whatever the journal has so LiveLog.json is up to date
+        if not history_save_event.wait(history_journal_compact_interval):
+            if history_journal_count > 0:
+                write_histories(compact=True)
+            continue
+
+        # Give any other saves coming in right after a moment to land, so they all get written out together
+        time.sleep(history_save_delay)
+        history_save_event.clear()
+
+        write_histories()
+
+
+# Writes out the history changes and the RAG database now. Compacts the journal if it has gotten long (or if asked to)
+def write_histories(compact=False):
+    global history_journal_records, history_journal_count
+
+    with history_write_lock:
+
+        # Grab the changes along with the history they lead to, so they always match up
+        with history_journal_lock:
+            records = history_journal_records
+            history_journal_records = []
+            history_to_save = list(ooga_history)
+
+        if compact or history_journal_count + len(records) >= history_journal_compact_limit:
+            compact_history_journal(history_to_save)
+        else:
+            append_history_journal(records)
+
+        # Save RAG database too
+        utils.based_rag.store_rag_history()
+
+
+# Appends the changes to the journal, starting a new one with the fingerprint of the LiveLog.json it goes on top of
+def append_history_journal(records):
+    global history_journal_count
+
+    if len(records) == 0:
+        return
+
+    history_journal_count += len(records)
+
+    if not os.path.exists(history_journal_file):
+        records = [{'op': "base", 'live_log': history_journal_base}] + records
+
+    with open(history_journal_file, 'a', encoding='utf-8') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record) + "\n")
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+# Folds the journal into LiveLog.json, by writing out the whole history then clearing the journal. The last one gets
+# kept as the continual backup
+def compact_history_journal(history_to_save):
+    global history_journal_count, history_journal_base
+
+    if os.path.exists("LiveLog.json"):
+        shutil.copyfile("LiveLog.json", "Backups/LiveLogBackupContinual.bak")
+
+    history_journal_base = write_json_atomic("LiveLog.json", history_to_save)
+
+    if os.path.exists(history_journal_file):
+        os.remove(history_journal_file)
+
+    history_journal_count = 0
+
+
+# Replays the journal on top of the history loaded from LiveLog.json (given its fingerprint). Only if the journal goes on
+# top of that exact file; otherwise it was already folded in (closed between writing LiveLog.json and clearing the
+# journal), or LiveLog.json got swapped out, so it gets dropped. Stops at a half-written last line
+def replay_history_journal(live_log_fingerprint):
+    global history_journal_count, history_journal_base
+
+    history_journal_count = 0
+    history_journal_base = live_log_fingerprint
+
+    if not os.path.exists(history_journal_file):
+        return
+
+    records = []
+    torn = False
+    with open(history_journal_file, 'r', encoding='utf-8') as openfile:
+        for line in openfile:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                torn = True
+                break
+
+    if len(records) == 0 or records[0].get('op') != "base" or records[0].get('live_log') != live_log_fingerprint:
+        os.remove(history_journal_file)
+        return
+
+    # Cut off the half-written line, so new changes don't get appended onto it
+    if torn:
+        with open(history_journal_file, 'w', encoding='utf-8') as outfile:
+            for record in records:
+                outfile.write(json.dumps(record) + "\n")
+
+    for record in records:
+        if record['op'] == "add":
+            ooga_history.append(record['pair'])
+        elif record['op'] == "pop":
+            ooga_history.pop()
+        elif record['op'] == "delete":
+            del ooga_history[record['index']]
+        elif record['op'] == "tags":
+            set_history_tags(record['index'], record['tags'])
+
+    history_journal_count = len(records) - 1
+
+
+# Writes out anything still waiting to be saved right away, and leaves LiveLog.json complete (for closing down)
+def flush_histories():
+
+    history_save_event.clear()
+
+    if history_loaded:
+        write_histories(compact=True)
+
+
+# Writes JSON to a temporary file then swaps it in, so a crash mid-write never leaves a broken file. Gives back its fingerprint
+def write_json_atomic(file_name, data):
+
+    json_bytes = json.dumps(data, indent=4).encode('utf-8')
+
+    with open(file_name + ".tmp", 'wb') as outfile:
+        outfile.write(json_bytes)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    os.replace(file_name + ".tmp", file_name)
+
+    # Fingerprint of what got written
+    return hashlib.sha256(json_bytes).hexdigest()
+
+
+# Make sure nothing waiting to be saved gets lost on closing
+atexit.register(flush_histories)
 
 
 
@@ -792,7 +1045,7 @@ def soft_reset():
 
     for message_pair in soft_reset_message:
 
-        ooga_history.append([message_pair[0], message_pair[1],  message_pair[1], utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+        add_to_history([message_pair[0], message_pair[1],  message_pair[1], utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
 
 
@@ -815,7 +1068,7 @@ def prune_deletables():
 
     while i < len(ooga_history) - 8:
         if utils.cane_lib.keyword_check(ooga_history[i][0], ["[System D]"]):
-            del ooga_history[i]
+            delete_from_history(i)
             i = len(ooga_history) - 27
             if i < 0:
                 i = 0
@@ -932,7 +1185,7 @@ def summary_memory_run_hard(messages_input, user_sent_message):
     log_user_input = "{0}".format(user_sent_message)
     log_received_message = "{0}".format(received_message)
 
-    ooga_history.append([log_user_input, log_received_message, utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+    add_to_history([log_user_input, log_received_message, utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
     # Run a pruning of the deletables
     prune_deletables()
@@ -1260,7 +1513,7 @@ def view_image(direct_talk_transcript):
             'preset': OOBA_VISUAL_PRESET_NAME
         }
 
-        response = requests.post(IMG_URI, json=request)
+        response = API.oobaooga_api.post_request(IMG_URI, request)
         received_cam_message = response.json()['choices'][0]['message']['content']
 
     elif API_TYPE_VISUAL == "Ollama":
@@ -1305,7 +1558,7 @@ def view_image(direct_talk_transcript):
     these_tags = utils.settings.cur_tags.copy()
     these_tags.append("ZW-Visual")
 
-    ooga_history.append([base_send, received_cam_message, these_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+    add_to_history([base_send, received_cam_message, these_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
 
     # Save
@@ -1483,7 +1736,7 @@ def view_image_streaming(direct_talk_transcript):
         }
 
         # Actual streaming bit
-        stream_response = requests.post(IMG_URI, headers=headers, json=request, verify=False, stream=True)
+        stream_response = API.oobaooga_api.post_request(IMG_URI, request, stream=True)
         client = sseclient.SSEClient(stream_response)
 
         streamed_api_stringpuller = client.events()
@@ -1543,7 +1796,7 @@ def view_image_streaming(direct_talk_transcript):
         # Cut for the hangout name being said
         if streamed_response_check == "Hangout-Name-Cut" and utils.settings.hangout_mode:
             # Add any existing stuff to our actual chat history
-            ooga_history.append([direct_talk_transcript, assistant_message, utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+            add_to_history([direct_talk_transcript, assistant_message, utils.settings.cur_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
             save_histories()
 
             # Remove flag
@@ -1628,7 +1881,7 @@ def view_image_streaming(direct_talk_transcript):
     these_tags = utils.settings.cur_tags.copy()
     these_tags.append("ZW-Visual")
 
-    ooga_history.append([base_send, received_cam_message, these_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
+    add_to_history([base_send, received_cam_message, these_tags, "{:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now())])
 
 
     # Save
@@ -1708,6 +1961,11 @@ def encode_new_api(user_input):
     if API_TYPE == "LMStudio":
         return encode_new_api_lmstudio(user_input)
 
+    #
+    # Check for the cached layout (the card gets added on Oobabooga's side, so it is up front already)
+    if prompt_layout == "Cached":
+        return encode_cached_layout(user_input, False)
+
     messages_to_send = []
 
     message_marker = len(ooga_history) - marker_length
@@ -1762,6 +2020,10 @@ def encode_new_api(user_input):
                 if len(utils.retrospect.live_summarization_log) > 1:
                     messages_to_send.append({"role": "assistant", "content": utils.retrospect.live_summarization_log[-2]})
 
+                # And any older summaries we recalled
+                if utils.rag_summaries.call_summary_message() != "":
+                    messages_to_send.append({"role": "user", "content": utils.rag_summaries.call_summary_message()})
+
 
 
         i = i + 1
@@ -1786,6 +2048,10 @@ def encode_new_api_ollama(user_input):
 
     global ooga_history
 
+    # Cached layout, with only the card and task in the system message
+    if prompt_layout == "Cached":
+        return encode_cached_layout(user_input, True)
+
     messages_to_send = []
 
     # Append our system message, if we are using OLLAMA
@@ -1804,6 +2070,10 @@ def encode_new_api_ollama(user_input):
     if utils.settings.rag_enabled:
         ollama_composite_content += utils.based_rag.call_rag_message() + "\n\n"
 
+    # Older summaries we recalled
+    if utils.retrospect.use_rolling_summaries and utils.rag_summaries.call_summary_message() != "":
+        ollama_composite_content += utils.rag_summaries.call_summary_message() + "\n\n"
+
     # Also append the summary #2 here, as it will be good spacing to be placed here
     if utils.retrospect.use_rolling_summaries:
         if len(utils.retrospect.live_summarization_log) > 1:
@@ -1857,6 +2127,10 @@ def encode_new_api_lmstudio(user_input):
 
     global ooga_history
 
+    # Cached layout, with only the card and task in the system message
+    if prompt_layout == "Cached":
+        return encode_cached_layout(user_input, True)
+
     messages_to_send = []
 
     # Append our system message, if we are using OLLAMA
@@ -1875,6 +2149,10 @@ def encode_new_api_lmstudio(user_input):
     if utils.settings.rag_enabled:
         lmstudio_composite_content += utils.based_rag.call_rag_message() + "\n\n"
 
+    # Older summaries we recalled
+    if utils.retrospect.use_rolling_summaries and utils.rag_summaries.call_summary_message() != "":
+        lmstudio_composite_content += utils.rag_summaries.call_summary_message() + "\n\n"
+
     # Lorebook Gathering
     lore_gathered = utils.lorebook.lorebook_gather(ooga_history[-3:], user_input)
 
@@ -1916,6 +2194,96 @@ def encode_new_api_lmstudio(user_input):
     return messages_to_send
 
 
+# Encodes for the cached layout. Goes from what changes least to what changes most; the card (and task), the older
+# summary, the history from the start of its block, then our message with the RAG, lore and time in front of it. Each
+# turn keeps everything but the last message of the one before, until the history moves along to its next block
+def encode_cached_layout(user_input, send_card):
+    global last_cached_prompt, last_cached_window_start
+
+    messages_to_send = []
+
+    # Card & task, if it is ours to send
+    if send_card:
+        stable_content = API.character_card.character_card + "\n\n"
+
+        if utils.settings.cur_task_char != "" and utils.settings.cur_task_char != "None":
+            stable_content += utils.tag_task_controller.get_cur_task_description() + "\n\n"
+
+        messages_to_send.append({"role": "system", "content": stable_content})
+
+    # Summary #2, only changes when a new summary gets made
+    if utils.retrospect.use_rolling_summaries:
+        if len(utils.retrospect.live_summarization_log) > 1:
+            messages_to_send.append({"role": "assistant", "content": utils.retrospect.live_summarization_log[-2]})
+
+    # History, from the start of the current block
+    window_start = get_cached_window_start()
+    for message_pair in ooga_history[window_start:]:
+        messages_to_send.append({"role": "user", "content": message_pair[0]})
+        messages_to_send.append({"role": "assistant", "content": message_pair[1]})
+
+    # Everything that changes each turn goes in our message, so the next turn's history can take its place
+    volatile_content = ""
+
+    if utils.settings.rag_enabled:
+        volatile_content += utils.based_rag.call_rag_message() + "\n\n"
+
+    if utils.retrospect.use_rolling_summaries and utils.rag_summaries.call_summary_message() != "":
+        volatile_content += utils.rag_summaries.call_summary_message() + "\n\n"
+
+    lore_gathered = utils.lorebook.lorebook_gather(ooga_history[-3:], user_input)
+
+    if lore_gathered != utils.lorebook.total_lore_default:
+        volatile_content += lore_gathered + "\n\n"
+
+    if ENCODE_TIME == "ON":
+        timestamp_string = "The current time now is "
+        current_time = datetime.datetime.now()
+        timestamp_string += current_time.strftime("%d %B, %Y at %I:%M %p")
+        timestamp_string += "."
+        volatile_content += timestamp_string + "\n\n"
+
+    #
+    # Append our most recent message
+    #
+
+    messages_to_send.append({"role": "user", "content": volatile_content + user_input})
+
+    # Check it starts with the last prompt (all but its last message), so the server can reuse its cache
+    shared_count = count_shared_messages(last_cached_prompt, messages_to_send)
+    if window_start == last_cached_window_start and shared_count < len(last_cached_prompt) - 1:
+        utils.zw_logging.update_debug_log("Cached layout; prompt only starts with " + str(shared_count) + " of the last "
+                                          + str(len(last_cached_prompt)) + " messages, the server will have to re-read the rest.")
+
+    last_cached_prompt = messages_to_send
+    last_cached_window_start = window_start
+
+    return messages_to_send
+
+
+# How many messages two prompts start with that are the same
+def count_shared_messages(old_messages, new_messages):
+
+    shared_count = 0
+    while shared_count < len(old_messages) and shared_count < len(new_messages):
+        if old_messages[shared_count] != new_messages[shared_count]:
+            break
+        shared_count += 1
+
+    return shared_count
+
+
+# Where the history starts in the cached layout. Sends at least our marker length of pairs, moving the start along a
+# whole block at a time (so up to a block more than the marker length gets sent)
+def get_cached_window_start():
+
+    window_start = len(ooga_history) - marker_length
+    if window_start <= 0:
+        return 0
+
+    return window_start - (window_start % prompt_cache_block)
+
+
 # encodes a given input to the new API, with no additives (except the summary, SLIME)
 def encode_raw_new_api(user_messages_input, user_message_last, raw_marker_length):
     #
@@ -2001,7 +2369,7 @@ def force_tokens_count(tokens):
 
 def pop_if_sent_is_latest(user_input):
     if user_input == ooga_history[-1][0]:
-        ooga_history.pop()
+        pop_from_history()
 
 def check_for_name_in_message(message):
     global last_message_received_has_own_name
@@ -5,6 +5,7 @@ import lmstudio as lms
 import os
 import API.api_controller
 import json
+import threading
 
 lmstudio_model = os.environ.get("ZW_LMSTUDIO_MODEL")
 lmstudio_model_visual = os.environ.get("ZW_LMSTUDIO_MODEL_VISUAL")
@@ -13,16 +14,22 @@ lmstudio_model_visual = os.environ.get("ZW_LMSTUDIO_MODEL_VISUAL")
 with open("Configurables/LMStudioModelConfigs.json", 'r') as openfile:
     model_configs = json.load(openfile)
 
-def api_standard(history, temp_level, stop, max_tokens):
+# Model handles, looked up once per model and reused (dropped if one stops working, like if the model got unloaded)
+model_handles = {}
 
-    # Model needed?
+# With the cached prompt layout, each prompt starts with all but the last message of the one before. So we keep a chat
+# of everything but the last message, add the new ones on the end each turn, and send a copy with the last one added.
+# Kept with the (role, content) of what is in it, to check the next prompt really does start with it
+cached_chat = None
+cached_entries = []
+chat_cache_lock = threading.Lock()
 
-    model = lms.llm(lmstudio_model)
 
-    history_as_dict = dict(messages=history)
-    chat = lms.Chat.from_history(history_as_dict)
+def api_standard(history, temp_level, stop, max_tokens):
+
+    chat = get_chat(history)
 
-    response = model.respond(chat, config=get_temperature_options(temp_level, stop, max_tokens))
+    response = respond(lmstudio_model, chat, get_temperature_options(temp_level, stop, max_tokens))
 
 
     return response.content
@@ -30,17 +37,12 @@ def api_standard(history, temp_level, stop, max_tokens):
 
 def api_stream(history, temp_level, stop, max_tokens):
 
-    model = lms.llm(lmstudio_model)
+    chat = get_chat(history)
 
-    history_as_dict = dict(messages=history)
-    chat = lms.Chat.from_history(history_as_dict)
-
-    return model.respond_stream(chat, config=get_temperature_options(temp_level, stop, max_tokens))
+    return respond(lmstudio_model, chat, get_temperature_options(temp_level, stop, max_tokens), stream=True)
 
 def api_standard_image(history, text_input, temp_level, stop, max_tokens):
 
-    model = lms.llm(lmstudio_model)
-
     history_as_dict = dict(messages=history)
     chat = lms.Chat.from_history(history_as_dict)
 
@@ -48,14 +50,12 @@ def api_standard_image(history, text_input, temp_level, stop, max_tokens):
     image_handle = lms.prepare_image(img_path)
     chat.add_user_message(text_input, images=[image_handle])
 
-    response = model.respond(chat, config=get_temperature_options(temp_level, stop, max_tokens))
+    response = respond(lmstudio_model, chat, get_temperature_options(temp_level, stop, max_tokens))
 
     return response
 
 def api_stream_image(history, text_input, temp_level, stop, max_tokens):
 
-    model = lms.llm(lmstudio_model)
-
     history_as_dict = dict(messages=history)
     chat = lms.Chat.from_history(history_as_dict)
 
@@ -63,7 +63,89 @@ def api_stream_image(history, text_input, temp_level, stop, max_tokens):
     image_handle = lms.prepare_image(img_path)
     chat.add_user_message(text_input, images=[image_handle])
 
-    return model.respond_stream(chat, config=get_temperature_options(temp_level, stop, max_tokens))
+    return respond(lmstudio_model, chat, get_temperature_options(temp_level, stop, max_tokens), stream=True)
+
+
+# Gets the model handle, looking it up only the first time
+def get_model(model_key):
+
+    if model_key not in model_handles:
+        model_handles[model_key] = lms.llm(model_key)
+
+    return model_handles[model_key]
+
+
+# Sends the chat to the model. If the kept handle has gone stale (the model got unloaded, or the connection to LM Studio
+# dropped), it gets looked up again and we try once more. Anything else is a real error, and gets passed on
+def respond(model_key, chat, config, stream=False):
+
+    if stream:
+        return respond_stream(model_key, chat, config)
+
+    try:
+        return get_model(model_key).respond(chat, config=config)
+
+    except (lms.LMStudioModelNotFoundError, lms.LMStudioWebsocketError, ConnectionError):
+        model_handles.pop(model_key, None)
+
+    return get_model(model_key).respond(chat, config=config)
+
+
+# Streams the reply. A stale handle only shows up once we start reading the stream, so the retry happens in here. It is
+# only retried if nothing has come through yet, as we can't take back a half reply that has already been spoken
+def respond_stream(model_key, chat, config):
+
+    got_fragment = False
+    try:
+        for fragment in get_model(model_key).respond_stream(chat, config=config):
+            got_fragment = True
+            yield fragment
+        return
+
+    except (lms.LMStudioModelNotFoundError, lms.LMStudioWebsocketError, ConnectionError):
+        if got_fragment:
+            raise
+        model_handles.pop(model_key, None)
+
+    for fragment in get_model(model_key).respond_stream(chat, config=config):
+        yield fragment
+
+
+# Gets the chat for the given history. Only the prompts from the cached layout get kept and added onto, anything else
+# (Classic layout, summaries) gets built from the whole history like normal
+def get_chat(history):
+    global cached_chat, cached_entries
+
+    if history is not API.api_controller.last_cached_prompt or len(history) == 0:
+        return lms.Chat.from_history(dict(messages=history))
+
+    entries = [(message['role'], message['content']) for message in history[:-1]]
+
+    with chat_cache_lock:
+        kept_chat = cached_chat
+        kept_entries = cached_entries
+
+        # Forget it first, so if a message can't be added it gets built fresh next time
+        cached_chat = None
+        cached_entries = []
+
+        # Only add the new messages if it starts with everything we kept (the history moving to its next block, or a
+        # new summary, changes the start, so then it gets built again)
+        if kept_chat is None or entries[:len(kept_entries)] != kept_entries:
+            kept_chat = lms.Chat.from_history(dict(messages=history[:-1]))
+        else:
+            for role, content in entries[len(kept_entries):]:
+                kept_chat.add_entry(role, content)
+
+        cached_chat = kept_chat
+        cached_entries = entries
+
+        # Our message goes on a copy, so the kept chat only has what the next prompt will start with
+        chat = kept_chat.copy()
+
+    chat.add_entry(history[-1]['role'], history[-1]['content'])
+
+    return chat
 
 
 def get_temperature_options(temp_level, stop, max_tokens):
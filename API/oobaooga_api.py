@@ -1,5 +1,7 @@
 import requests
 import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HOST = os.environ.get("HOST_PORT")
 URI = f'http://{HOST}/v1/chat/completions'
@@ -9,10 +11,78 @@ headers = {
     "Content-Type": "application/json"
 }
 
+# How long to wait to connect, and then for the server to send anything (between streamed chunks, when streaming).
+# A read timeout of 0 waits as long as it takes, as long generations on CPU can take a while
+connect_timeout = float(os.environ.get("OOBA_CONNECT_TIMEOUT", "5"))
+read_timeout = float(os.environ.get("OOBA_READ_TIMEOUT", "0"))
+if read_timeout <= 0:
+    read_timeout = None
+
+# How many times to retry if we can't connect to the server
+connection_retries = int(os.environ.get("OOBA_CONNECTION_RETRIES", "3"))
+
+
+#
+# One shared session for every call to Oobabooga (chat, summaries, and the visual model), so connections get kept alive
+# and reused, rather than opening a fresh one every time we generate.
+#
+
+def make_session():
+
+    new_session = requests.Session()
+
+    # Only retry on failing to connect (safe for POST too, as nothing was sent yet). Never once the request went out, as
+    # a slow or dropped reply would get generated all over again. A kept-alive connection getting reset is handled in
+    # post_request instead
+    retries = Retry(total=connection_retries, connect=connection_retries, read=0, status=0, redirect=0,
+                    backoff_factor=0.25, raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    return new_session
+
+
+session = make_session()
+
+
+# Sends a request to the given Oobabooga endpoint, over the shared session. If the connection gets reset before anything
+# at all came back (usually a kept-alive one the server already closed), it gets sent once more on a fresh connection.
+# Nothing is retried once the reply has started, as it would get generated all over again
+def post_request(uri, request, stream=False):
+
+    try:
+        return session.post(uri, headers=headers, json=request, verify=False, stream=stream, timeout=(connect_timeout, read_timeout))
+
+    except requests.exceptions.ConnectionError as error:
+        if not is_connection_reset(error):
+            raise
+
+    return session.post(uri, headers=headers, json=request, verify=False, stream=stream, timeout=(connect_timeout, read_timeout))
+
+
+# Checks if a connection error came from the connection being reset or closed on us (RemoteDisconnected is one too)
+def is_connection_reset(error):
+
+    errors_to_check = [error]
+    while len(errors_to_check) > 0:
+        cur_error = errors_to_check.pop()
+
+        if isinstance(cur_error, ConnectionResetError):
+            return True
+
+        for cause in list(cur_error.args) + [getattr(cur_error, 'reason', None)]:
+            if isinstance(cause, BaseException):
+                errors_to_check.append(cause)
+
+    return False
+
+
 # Send using the non-streaming API
 def api_standard(request):
 
-    response = requests.post(URI, headers=headers, json=request, verify=False)
+    response = post_request(URI, request)
 
     received_message = response.json()['choices'][0]['message']['content']
 
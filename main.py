@@ -33,6 +33,9 @@ import utils.web_ui
 import utils.settings
 import utils.retrospect
 import utils.based_rag
+import utils.rag_recency
+import utils.rag_summaries
+import utils.tokenizer
 import utils.tag_task_controller
 import utils.gaming_control
 import utils.hangout
@@ -1025,6 +1028,48 @@ def run_program():
     utils.retrospect.search_point_size = int(os.environ.get("SEARCH_POINT_SIZE"))
     utils.retrospect.summary_tokens_max_count = int(os.environ.get("SUMMARY_TOKENS_MAX_COUNT"))
 
+    utils.based_rag.rag_backend = os.environ.get("RAG_BACKEND", "Index")
+    utils.based_rag.rag_scoring = os.environ.get("RAG_SCORING", "Classic")
+    utils.based_rag.rag_engine = os.environ.get("RAG_ENGINE", "Keyword")
+    utils.based_rag.rag_memory_windows = int(os.environ.get("RAG_MEMORY_WINDOWS", "1"))
+    utils.based_rag.rag_token_budget = int(os.environ.get("RAG_TOKEN_BUDGET", "600"))
+
+    rag_speculative_string = os.environ.get("RAG_SPECULATIVE", "OFF")
+    if rag_speculative_string == "ON":
+        utils.based_rag.rag_speculative = True
+    else:
+        utils.based_rag.rag_speculative = False
+
+    utils.based_rag.rag_rebuild_workers = int(os.environ.get("RAG_REBUILD_WORKERS", "1"))
+    utils.based_rag.rag_keyword_count = int(os.environ.get("RAG_KEYWORD_COUNT", "6"))
+    utils.based_rag.rag_her_word_limit = int(os.environ.get("RAG_HER_WORD_LIMIT", "2"))
+    utils.based_rag.stop_word_ratio = float(os.environ.get("RAG_STOP_WORD_RATIO", "0.000937"))
+
+    rag_memory_budget_string = os.environ.get("RAG_MEMORY_BUDGET", "OFF")
+    if rag_memory_budget_string == "ON":
+        utils.based_rag.rag_memory_budget = True
+    else:
+        utils.based_rag.rag_memory_budget = False
+
+    utils.based_rag.rag_hot_history_pairs = int(os.environ.get("RAG_HOT_HISTORY_PAIRS", "5000"))
+
+    utils.rag_recency.recency_weight = float(os.environ.get("RAG_RECENCY_WEIGHT", "0"))
+    utils.rag_recency.recency_half_life_days = float(os.environ.get("RAG_RECENCY_HALF_LIFE_DAYS", "30"))
+    utils.rag_recency.pinned_boost = float(os.environ.get("RAG_PINNED_BOOST", "0"))
+
+    utils.rag_summaries.summary_recall_count = int(os.environ.get("RAG_SUMMARY_COUNT", "0"))
+    utils.rag_summaries.summary_engine = utils.based_rag.rag_engine
+
+    rag_tag_shards_string = os.environ.get("RAG_TAG_SHARDS", "OFF")
+    if rag_tag_shards_string == "ON":
+        utils.based_rag.rag_tag_shards = True
+    else:
+        utils.based_rag.rag_tag_shards = False
+
+    tokenizer_stemming_string = os.environ.get("TOKENIZER_STEMMING", "OFF")
+    tokenizer_unicode_string = os.environ.get("TOKENIZER_UNICODE_PUNCTUATION", "OFF")
+    utils.tokenizer.set_options(tokenizer_stemming_string == "ON", tokenizer_unicode_string == "ON")
+
 
     # Load in our char name
     utils.settings.char_name = char_name
@@ -1,7 +1,9 @@
 import sys
+import bisect
+import heapq
+import collections
 
 import API.api_controller
-import string
 import threading
 import utils.lorebook
 import random
@@ -10,6 +12,15 @@ import os
 import time
 import utils.zw_logging
 import utils.settings
+import utils.rag_sparse
+import utils.rag_bm25
+import utils.rag_embed
+import utils.rag_recency
+import utils.rag_binary
+import utils.rag_rebuild
+import utils.tag_task_controller
+import utils.tokenizer
+import numpy as np
 from tqdm import tqdm
 
 # Words and their data
@@ -17,9 +28,13 @@ word_database = {
     'word': ["", " ", "the", "it"],
     'count': [1, 1, 1, 1],
     'value': [0.0, 0.0, 0.0, 0.0],
-    'total_word_count': 0
+    'total_word_count': 0,
+    'stop_word_ratio': 0.000937        # The ratio the history was pruned with (saved)
 }
 
+# Index from each word to its ID in the word database, so lookups don't have to scan every word (not saved, rebuilt on load)
+word_index = {}
+
 # Histories
 histories_word_id_database = {
     'me': [],
@@ -27,6 +42,28 @@ histories_word_id_database = {
     'scores': []
 }
 
+# Inverted index, from each word ID to the message pairs that contain it, plus the message pairs where both messages have
+# no words left to search for (these still score 0, not less). Loaded from the saved one, if there is one; words not
+# touched since get read from it as they are searched for (see utils.rag_binary), otherwise they are all in here
+word_postings = {
+    'me': {},
+    'her': {},
+    'empty': [],
+    'saved': None
+}
+
+# Words used more than this share of the time are too common to search with, and get pruned out of the history
+stop_word_ratio = 0.000937
+
+# The words that are too common right now (not saved, worked out from the word counts)
+stop_word_ids = set()
+
+# Per-tag shards of the inverted index, so searches can stick to the current task or tags (like "Auto-Gaming"). Each one
+# is laid out like the main index, plus its pairs. The main index is still all of them together (not saved)
+rag_tag_shards = False
+tag_shards = {}
+pair_tags = []          # The tags each message pair got sharded under
+
 history_database = [["Start of all history!", "Start of all history!"]]
 
 show_rag_debug = True
@@ -39,8 +76,65 @@ history_demarc = 20         # This is the point where the history gets considere
 manual_recalculate_ignore_latest = False
 is_setting_up = True
 
+# Changes since the last save, to be written to the journal (see utils.rag_binary)
+journal_pending_records = []
+journal_word_mark = 0               # Words from here on are new since the last save
+journal_count_deltas = {}
+journal_total_delta = 0
+journal_snapshot_needed = False     # Set after a full rebuild, where it's easier to just save it all
+
 char_name = os.environ.get("CHAR_NAME")
 
+# How many keywords to search with, and the most of them that can come from her last message
+rag_keyword_count = 6
+rag_her_word_limit = 2
+
+# How many processes to rebuild the database with. 1 just does it all on this one
+rag_rebuild_workers = 1
+
+# What to search with. "Index" uses the inverted word index, "Sparse" uses the NumPy sparse matrix (faster on huge histories)
+rag_backend = "Index"
+
+# How to rank message pairs. "Classic" counts keyword hits, "BM25" uses BM25 ranking (stats are kept up to date as we go)
+rag_scoring = "Classic"
+
+# Which memory engine to recall with. "Keyword" is this RAG, "Embedding" recalls by meaning instead (see utils.rag_embed)
+rag_engine = "Keyword"
+
+# How many memory windows (a message pair and the ones around it) to recall, and the most tokens they can take up.
+# 1 is the classic single window around the best message pair
+rag_memory_windows = 1
+rag_token_budget = 600
+token_encoder = None
+
+# Cache of what we have searched for, to the memory windows we found, so rerolls and re-sends skip the search.
+# Keyed with the database generation, which goes up whenever the searchable history changes, so old ones never get used
+rag_query_cache = collections.OrderedDict()
+rag_query_cache_size = 64
+rag_database_generation = 0
+
+# Speculative RAG; searches with what has been said so far, while we are still talking (chunky transcription only)
+rag_speculative = False
+speculative_pending_message = None
+speculative_thread = None
+speculative_lock = threading.Lock()
+last_added_history_mark = None      # The chat history we last added from, so we never add the same one twice
+
+# Thread safety. Searches come in from the chat, Discord, Minecraft and the web UI, maybe all at once, while only one
+# thing writes at a time (under the write lock). Searches don't lock at all, they work off the read snapshot; the
+# message pairs as of the last finished write. Writes only ever add or undo the newest pair, and anything that gets
+# rebuilt, shrunk, or recalculated is made fresh and swapped in (copy-on-write), so what a search looks at holds still
+rag_write_lock = threading.RLock()
+read_snapshot = {'generation': 0, 'pair_count': 0, 'me': [], 'her': []}
+rag_query_cache_lock = threading.Lock()
+
+# Memory budget mode; keeps only the newest history pairs and the words used more than once in memory. The rest stay on
+# disk in the saved snapshot (the cold tier, see utils.rag_binary) and get read back when needed. Postings stay in memory
+rag_memory_budget = False
+rag_hot_history_pairs = 5000
+history_evict_mark = 0              # History pairs before this have been checked for eviction
+word_evict_mark = 0                 # Same for words
+
 
 #
 # Anyone who is wondering what this is for, this is a RAG, or Retrivial Agumented Generation system. A very basic one, at that.
@@ -61,10 +155,6 @@ def setup_based_rag():
     global is_setting_up
     global history_database
 
-    #
-    # IMPLEMENT SMART THREADING: Split it per thread and continually grab next order
-    #
-
     #
     # HISTORY LOGS
     #
@@ -87,14 +177,22 @@ def setup_based_rag():
     # LIVE HISTORY
     #
 
-    # Main loop that will run through and count all uses of a given word
-    # Thread this as well eventually
+    # Main loop that will run through and count all uses of a given word, split over multiple processes if we want
 
-    for history in tqdm(history_database, file=sys.stdout):
+    if rag_rebuild_workers > 1:
+        with tqdm(total=len(history_database), file=sys.stdout) as progress_bar:
+            shard_results = utils.rag_rebuild.count_history_parallel([get_history_pair(pair_id) for pair_id in range(len(history_database))],
+                                                                     rag_rebuild_workers, progress_bar)
+
+        merge_shard_counts(shard_results)
+
+    else:
+        for pair_id in tqdm(range(len(history_database)), file=sys.stdout):
 
-        # Add in each message pair
-        parse_words_to_database(history[0], 0)
-        parse_words_to_database(history[1], 1)
+            # Add in each message pair (read through, as loaded history may only be on disk)
+            history = get_history_pair(pair_id)
+            parse_words_to_database(history[0], 0)
+            parse_words_to_database(history[1], 1)
 
 
 
@@ -108,20 +206,49 @@ def setup_based_rag():
 
 
 
-    # Clear out any common words from the database index, for searching purposes
-    # Thread this as well eventually
+    # Clear out any common words from the database index, for searching purposes (all found at once, then one pass per pair)
+    calc_stop_words()
+    word_database['stop_word_ratio'] = stop_word_ratio
+
     i = 0
     while i < len(histories_word_id_database["me"]):
-        prune_common(i)
+        histories_word_id_database["me"][i] = prune_word_ids(histories_word_id_database["me"][i])
+        histories_word_id_database["her"][i] = prune_word_ids(histories_word_id_database["her"][i])
         i = i + 1
 
+    # Index which message pairs each word is in
+    rebuild_search_index()
+
+    # Embed all of the message pairs, if we are recalling by meaning
+    if rag_engine == "Embedding":
+        print("\nEmbedding all message pairs now...")
+        with tqdm(total=len(history_database), file=sys.stdout) as progress_bar:
+            utils.rag_embed.build_index(len(history_database), get_history_pair, progress_bar)
+
+
+    # Save it all right away if we are on a memory budget, so the old history can go out to the cold tier
+    if rag_memory_budget:
+        utils.rag_binary.use_cold_tier = True
+        utils.rag_binary.save_database(word_database, histories_word_id_database, history_database)
+        clear_journal_tracking()
+        reset_eviction_marks()
+        evict_cold_entries()
 
     # Flag us so we don't add latest message in
     manual_recalculate_ignore_latest = True
 
+    global last_added_history_mark, rag_database_generation
+    last_added_history_mark = None
+    rag_database_generation += 1
+
+    # Everything changed, so save a full snapshot next time rather than journaling (unless we just did)
+    global journal_snapshot_needed
+    journal_snapshot_needed = not rag_memory_budget
+
 
-    # Flag this as done
+    # Flag this as done, and let searches see it all
     is_setting_up = False
+    publish_read_snapshot()
 
 
     # Print out so we can see if the word database is working
@@ -140,9 +267,75 @@ def run_based_rag(message, her_previous):
     if not utils.settings.rag_enabled:
         return
 
+    # Let any speculative search finish up first, we may be able to use what it found
+    wait_for_speculative_rag()
+
     # Clear the log, a new operation is beginning
     utils.zw_logging.clear_rag_log()
 
+    # Search the database as it is right now, even if something gets added while we are at it
+    snapshot = read_snapshot
+
+    # Recalling by meaning skips all of the keyword work
+    if rag_engine == "Embedding":
+        search_key = ("Embedding", message, her_previous)
+
+        window_ids = get_cached_windows(search_key, snapshot)
+        if window_ids is None:
+            window_ids = search_memory_by_meaning(message, her_previous, snapshot)
+            cache_windows(search_key, window_ids, snapshot)
+
+        build_rag_memory(window_ids)
+        return
+
+
+    # Check the score value of all words
+    # NOTE: This is a maintenance item that doesn't need to run every time, so we just do it randomly
+    # (BM25 keeps the word values updated as they get counted, so it can skip this. Also skipped if something is writing)
+
+    if rag_scoring != "BM25":
+        random_recalc = random.randint(0, 100)
+        if random_recalc > 70 and rag_write_lock.acquire(blocking=False):
+            try:
+                calc_word_values()
+            finally:
+                rag_write_lock.release()
+
+
+    # Get the top scoring words, in order
+    highest_score_ids = find_memory_keywords(message, her_previous)
+
+    # Output our highest scoring words
+    if show_rag_debug:
+        x = 0
+        log_output_text = ""
+        while x < len(highest_score_ids):
+            log_output_text += str(get_word(highest_score_ids[x])) + "\n"
+            x = x + 1
+
+        utils.zw_logging.update_rag_log(log_output_text)
+
+
+    #
+    # NOW EVALUATE ALL MESSAGE PAIRS AND SCORE THEM
+    #
+
+
+    # Use what we found last time we searched with these keywords (like a reroll, or the speculative search), if we can
+    search_key = ("Keyword",) + tuple(sorted(highest_score_ids))
+
+    window_ids = get_cached_windows(search_key, snapshot)
+    if window_ids is None:
+        window_ids = search_memory_windows(highest_score_ids, snapshot)
+        cache_windows(search_key, window_ids, snapshot)
+
+    build_rag_memory(window_ids)
+
+
+
+# Finds the top scoring words of what is being said, to search our memories with
+def find_memory_keywords(message, her_previous):
+
     #
     # EVALUATE OUR SENT ONES FIRST
     #
@@ -152,14 +345,6 @@ def run_based_rag(message, her_previous):
     history_word_scores = []
 
 
-    # Check the score value of all words
-    # NOTE: This is a maintenance item that doesn't need to run every time, so we just do it randomly
-
-    random_recalc = random.randint(0, 100)
-    if random_recalc > 70:
-        calc_word_values()
-
-
     # Run evaluation now that we have all of the words
     i = 0
     while i < len(history_word_ids):
@@ -168,7 +353,7 @@ def run_based_rag(message, her_previous):
         score = word_database['value'][history_word_ids[i]]
 
         # Boost lore word score (only single word)
-        if utils.lorebook.rag_word_check(word_database['word'][history_word_ids[i]]):
+        if utils.lorebook.rag_word_check(get_word(history_word_ids[i])):
             score = (score + 1) / 2
 
         history_word_scores.append(score)
@@ -195,7 +380,7 @@ def run_based_rag(message, her_previous):
         score = word_database['value'][hers_history_word_ids[i]]
 
         # Boost lore word score (only single word)
-        if utils.lorebook.rag_word_check(word_database['word'][hers_history_word_ids[i]]):
+        if utils.lorebook.rag_word_check(get_word(hers_history_word_ids[i])):
             score = (score + 1) / 2
 
         history_word_ids.append(hers_history_word_ids[i])
@@ -206,198 +391,351 @@ def run_based_rag(message, her_previous):
 
 
 
-    # Get the top six scoring words, in order
-    highest_scores = [0, 0, 0, 0, 0, 0]
-    highest_score_keys = [0, 0, 0, 0, 0, 0]
-    highest_score_ids = [0, 0, 0, 0, 0, 0]
+    # Get the top scoring words, in order
+    return select_top_keywords(history_word_ids, history_word_scores, history_word_ids_feed_demarc)
 
-    j = 0
-    her_word_topper = False
-    her_word_count = 0
-    while j < len(highest_scores):
 
-        # Iterate to find highest scoring word, not including duplicates, and not including words with a perfect score
-        i = 0
 
-        while i < len(history_word_ids):
-            if history_word_scores[i] > highest_scores[j] and not highest_score_ids.__contains__(history_word_ids[i]):
-                highest_scores[j] = history_word_scores[i]
-                highest_score_keys[j] = i
-                highest_score_ids[j] = history_word_ids[i]
+# Finds the best memory windows for the given keywords, or just the best message pair if we only want one
+def search_memory_windows(highest_score_ids, snapshot):
 
-                # Controls for if she has added words
-                if i > history_word_ids_feed_demarc:
-                    her_word_topper = True
-                else:
-                    her_word_topper = False
+    if rag_memory_windows > 1:
+        return find_best_window_ids(highest_score_ids, snapshot)
 
-            i = i + 1
+    return [find_best_message_id(highest_score_ids, snapshot)]
 
-            # If she is at her word limit, skip all her words
-            if her_word_count >= 2 and i > history_word_ids_feed_demarc:
-                i = len(history_word_ids)
 
-        # Flag if the word we got was one of hers
-        if her_word_topper:
-            her_word_count += 1
+# Finds the best memory windows by meaning (see utils.rag_embed), or just the best message pair if we only want one
+def search_memory_by_meaning(message, her_previous, snapshot):
 
-        # Iterate to our next word, of course until we get to top 6 words
-        j = j + 1
+    cutoff_id = snapshot['pair_count'] - history_demarc
 
-    # Output our highest scoring words
-    if show_rag_debug:
-        x = 0
-        log_output_text = ""
-        while x < len(highest_score_ids):
-            log_output_text += str(word_database['word'][highest_score_ids[x]]) + "\n"
-            x = x + 1
+    search_tags = find_search_tags()
 
-        utils.zw_logging.update_rag_log(log_output_text)
+    if rag_memory_windows > 1:
+        pair_scores = utils.rag_embed.score_candidate_pairs(message, her_previous, cutoff_id, include_neighbours=True)
+        return pick_memory_windows(filter_tagged_pairs(pair_scores, search_tags), cutoff_id)
 
+    if search_tags is not None:
+        pair_scores = utils.rag_embed.score_candidate_pairs(message, her_previous, cutoff_id)
+        return [utils.rag_embed.pick_best_pair(filter_tagged_pairs(pair_scores, search_tags))]
 
-    #
-    # NOW EVALUATE ALL MESSAGE PAIRS AND SCORE THEM
-    #
+    return [utils.rag_embed.find_best_pair(message, her_previous, cutoff_id)]
 
 
-    # Evaluate
-    i = 0
-    while i < len(histories_word_id_database['me']):
-        score_value = evaluate_message(highest_score_ids, histories_word_id_database['me'][i]) + evaluate_message(highest_score_ids, histories_word_id_database['her'][i])
-        histories_word_id_database['scores'][i] = score_value
-        i = i + 1
+# Creates the memory for the current message, from the windows we found
+def build_rag_memory(window_ids):
 
+    if rag_memory_windows > 1:
+        build_rag_message_windows(window_ids)
+    else:
+        build_rag_message(window_ids[0])
 
-    # Print us out the best score & message
 
-    i = 1                       # Disallow message 1; always start on message 2 or higher
-    best_message_score = 0
-    best_message_id = 0
 
-    # Disallow any recalling from past the demarc. Should be able to recall / flow from there
-    while i < len(histories_word_id_database['me']) - history_demarc:
+# Creates the memory for the current message, out of the best message pair and the ones around it
+def build_rag_message(best_message_id):
 
-        central_score = histories_word_id_database['scores'][i-1]
-        central_score += histories_word_id_database['scores'][i]
-        central_score += histories_word_id_database['scores'][i+1]
+    global current_rag_message
 
-        # Less than or equal to makes it so that more recent entries are chosen, if equal
-        if best_message_score <= histories_word_id_database['scores'][i]:
-            best_message_id = i
-            best_message_score = histories_word_id_database['scores'][i]
+    current_rag_message = "[System M]; This is from your past memory, relevant to what is currently happening;\n"
+    current_rag_message += memory_window_text(best_message_id)
+    current_rag_message += "\n \n; This is the end of the memory!;"
 
-        i = i + 1
+    if show_rag_debug:
+        utils.zw_logging.update_rag_log(current_rag_message)
 
 
-    #
-    #   Create for the current message!
-    #
+# Creates the memory for the current message out of multiple windows, best first, fitting as many as we can into the
+# token budget. The best window always goes in, even if it is over the budget on its own
+def build_rag_message_windows(window_ids):
 
     global current_rag_message
 
-    current_rag_message = "[System M]; This is from your past memory, relevant to what is currently happening;\n"
-    current_rag_message += "User: " + history_database[best_message_id - 1][0] + "\n"
-    current_rag_message += char_name + ": " + history_database[best_message_id - 1][1] + "\n"
-    current_rag_message += "User: " + history_database[best_message_id][0] + "\n"
-    current_rag_message += char_name + ": " + history_database[best_message_id][1] + "\n"
-    current_rag_message += "User: " + history_database[best_message_id + 1][0] + "\n"
-    current_rag_message += char_name + ": " + history_database[best_message_id + 1][1] + "\n"
-    current_rag_message += "\n \n; This is the end of the memory!;"
+    message_start = "[System M]; This is from your past memory, relevant to what is currently happening;\n"
+    message_end = "\n \n; This is the end of the memory!;"
+    window_separator = "...\n"
+
+    used_tokens = count_tokens(message_start + message_end)
+    window_texts = []
+
+    for window_id in window_ids:
+        window_text = memory_window_text(window_id)
+        window_tokens = count_tokens(window_text)
+
+        if len(window_texts) > 0:
+            window_tokens += count_tokens(window_separator)
+
+            if used_tokens + window_tokens > rag_token_budget:
+                continue
+
+        window_texts.append(window_text)
+        used_tokens += window_tokens
+
+    current_rag_message = message_start + window_separator.join(window_texts) + message_end
 
     if show_rag_debug:
         utils.zw_logging.update_rag_log(current_rag_message)
 
 
+# The text of one memory window, the given message pair plus the ones right before and after it
+def memory_window_text(best_message_id):
 
-# Bit to actually receive what the RAG has to offer
-def call_rag_message():
-    return current_rag_message
+    window_text = ""
 
+    for history in [get_history_pair(best_message_id - 1), get_history_pair(best_message_id), get_history_pair(best_message_id + 1)]:
+        window_text += "User: " + history[0] + "\n"
+        window_text += char_name + ": " + history[1] + "\n"
 
+    return window_text
 
-def parse_words_to_database(message, flag):
 
-    global word_database
+# Gets a message pair from the history, reading it from the cold tier if it is not in memory
+def get_history_pair(pair_id):
+
+    history = history_database[pair_id]
+    if history is None:
+        history = utils.rag_binary.read_cold_history(pair_id % len(history_database))
+
+    return history
+
+
+# Counts how many tokens some text is. Uses tiktoken, or a rough guess if its encoding can't be loaded (it downloads it once)
+def count_tokens(text):
+    global token_encoder
+
+    if token_encoder is None:
+        try:
+            import tiktoken
+            token_encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            utils.zw_logging.update_debug_log("Could not load tiktoken for the RAG, guessing token counts instead! " + str(e))
+            token_encoder = False
+
+    if token_encoder is False:
+        return int(len(text) / 4) + 1
+
+    return len(token_encoder.encode(text, disallowed_special=()))
+
+
+
+# Picks the top scoring keywords, highest first, in one pass with a heap. Words past the feed demarc are hers, and only
+# so many of hers can get in. Ties go to the earlier word. Empty slots are left as word ID 0
+def select_top_keywords(word_ids, word_scores, feed_demarc):
+
+    # Only the first (and best scoring) use of each word is a candidate, and only if it scores anything.
+    # Word 0 is skipped too, it is what fills the empty slots
+    candidate_heap = []
+    seen_word_ids = {0}
 
-    # Count, using a word collector to detect when spaces are gone
     i = 0
-    word_collector = ""
-    word_start_marker = 0
-    history_word_ids = []
+    while i < len(word_ids):
+        if word_ids[i] not in seen_word_ids and word_scores[i] > 0:
+            seen_word_ids.add(word_ids[i])
+            candidate_heap.append((-word_scores[i], i, word_ids[i]))
 
+        i = i + 1
 
-    # Decide if we want to add to the count, depending on the flag
-    count_to_total = True
+    heapq.heapify(candidate_heap)
 
-    if flag == 2 or flag == 3:
-        count_to_total = False
+    highest_score_ids = []
+    her_word_count = 0
 
+    while len(candidate_heap) > 0 and len(highest_score_ids) < rag_keyword_count:
+        negative_score, i, word_id = heapq.heappop(candidate_heap)
 
+        # If she is at her word limit, skip all her words
+        if i > feed_demarc:
+            if her_word_count >= rag_her_word_limit:
+                continue
 
-    refined_message = message.translate(str.maketrans('', '', string.punctuation))
-    refined_message = str.lower(refined_message)
-    refined_message = refined_message.replace("\n", " ")
+            her_word_count += 1
 
-    if show_rag_debug_deep:
-        utils.zw_logging.update_rag_log(refined_message)
+        highest_score_ids.append(word_id)
 
+    # Fill out any empty slots
+    while len(highest_score_ids) < rag_keyword_count:
+        highest_score_ids.append(0)
 
-    while i < len(refined_message):
+    return highest_score_ids
 
-        if refined_message[i] == " ":
-            word_start_marker = i + 1
 
-        # Look for stopping, either spaces or end of message
-        if i + 1 == len(refined_message) or refined_message[i+1] == ' ':
+# Gets the memory windows we found last time for a search, or None if we haven't done it since the history changed
+def get_cached_windows(search_key, snapshot):
 
-            # Feed our word collector the marked version
-            word_collector = refined_message[word_start_marker:i+1]
+    cache_key = make_cache_key(search_key, snapshot)
 
-            j = 0
-            word_found = False
+    with rag_query_cache_lock:
+        if cache_key not in rag_query_cache:
+            return None
 
-            # Scan if word is in database
-            while j < len(word_database["word"]):
-                if word_collector == word_database["word"][j]:
+        rag_query_cache.move_to_end(cache_key)
+        return rag_query_cache[cache_key]
 
-                    if count_to_total:
-                        word_database["count"][j] = word_database["count"][j] + 1
 
-                    word_found = True
+# Remembers the memory windows we found for a search, dropping the least recently used one if we are full
+def cache_windows(search_key, window_ids, snapshot):
 
-                    # Add to our history word ID database
-                    history_word_ids.append(j)
+    cache_key = make_cache_key(search_key, snapshot)
 
-                j = j + 1
+    with rag_query_cache_lock:
+        rag_query_cache[cache_key] = window_ids
+        rag_query_cache.move_to_end(cache_key)
 
+        while len(rag_query_cache) > rag_query_cache_size:
+            rag_query_cache.popitem(last=False)
 
-            # If word not in database and we are counting, add it in (word will simply be skipped for eval parsing)
-            if not word_found and count_to_total:
-                word_database["word"].append(word_collector)
-                word_database["count"].append(1)
-                word_database["value"].append(0.99)         # Note: will have to be recalculated later on for new words
 
-                # Add to our history word ID database
-                history_word_ids.append(len(word_database["word"]) - 1)
+# The key a search is cached under; the search itself, the database generation it saw, and the tags we searched within
+def make_cache_key(search_key, snapshot):
+    return (snapshot['generation'], tuple(find_search_tags() or [])) + search_key
 
 
-            # Set the marker for our next word
-            word_start_marker = i + 2
+# Starts searching with what has been said so far, in the background, so the results are ready (or mostly ready) once
+# we are done talking. Only the latest message waiting gets searched, if we are still busy with an older one
+def start_speculative_rag(partial_message):
+    global speculative_pending_message, speculative_thread
 
-            # Boost again to skip space
-            i = i + 1
+    if not rag_speculative or not utils.settings.rag_enabled or is_setting_up:
+        return
+
+    with speculative_lock:
+        speculative_pending_message = partial_message
+
+        if speculative_thread is None:
+            speculative_thread = threading.Thread(target=speculative_rag_loop)
+            speculative_thread.daemon = True
+            speculative_thread.start()
+
+
+# Runs through the speculative searches, until there are none left
+def speculative_rag_loop():
+    global speculative_pending_message, speculative_thread
+
+    while True:
+        with speculative_lock:
+            partial_message = speculative_pending_message
+            speculative_pending_message = None
+
+            if partial_message is None:
+                speculative_thread = None
+                return
+
+        try:
+            # Add in the last message pair first, just like sending would, so what we find is still good once sent
+            add_message_to_database()
+
+            her_previous = API.api_controller.ooga_history[len(API.api_controller.ooga_history) - 1][1]
+            snapshot = read_snapshot
+
+            if rag_engine == "Embedding":
+                search_key = ("Embedding", partial_message, her_previous)
+                if get_cached_windows(search_key, snapshot) is None:
+                    cache_windows(search_key, search_memory_by_meaning(partial_message, her_previous, snapshot), snapshot)
+            else:
+                highest_score_ids = find_memory_keywords(partial_message, her_previous)
+                search_key = ("Keyword",) + tuple(sorted(highest_score_ids))
+                if get_cached_windows(search_key, snapshot) is None:
+                    cache_windows(search_key, search_memory_windows(highest_score_ids, snapshot), snapshot)
+
+        except Exception as e:
+            utils.zw_logging.update_debug_log("Speculative RAG search failed! " + str(e))
+
+
+# Waits for any speculative search to finish (and drops any that haven't started yet)
+def wait_for_speculative_rag():
+    global speculative_pending_message
+
+    # The speculative search itself doesn't wait on anything
+    if threading.current_thread() is speculative_thread:
+        return
+
+    with speculative_lock:
+        speculative_pending_message = None
+        running_thread = speculative_thread
+
+    if running_thread is not None:
+        running_thread.join()
+
+
+# Publishes the message pairs as they are now for searches to read, after a write (under the write lock)
+def publish_read_snapshot():
+    global read_snapshot
+
+    me_word_ids = histories_word_id_database['me']
+    her_word_ids = histories_word_id_database['her']
+
+    read_snapshot = {
+        'generation': rag_database_generation,
+        'pair_count': min(len(me_word_ids), len(her_word_ids)),
+        'me': me_word_ids,
+        'her': her_word_ids
+    }
+
+
+# Bit to actually receive what the RAG has to offer
+def call_rag_message():
+    return current_rag_message
+
+
+
+def parse_words_to_database(message, flag):
+
+    global word_database, journal_total_delta
+
+    history_word_ids = []
+
+
+    # Decide if we want to add to the count, depending on the flag
+    count_to_total = True
+
+    if flag == 2 or flag == 3:
+        count_to_total = False
+
+
+    message_words = utils.tokenizer.split_rag_words(message)
+
+    if show_rag_debug_deep:
+        utils.zw_logging.update_rag_log(message_words)
+
+
+    for word_collector in message_words:
 
+        word_found = False
 
-            # Clear the word
-            word_collector = ""
+        # Check if word is in database
+        j = find_word_id(word_collector, count_to_total)
+        if j is not None:
 
-            # Boost our total word count
             if count_to_total:
-                word_database['total_word_count'] = word_database['total_word_count'] + 1
+                word_database["count"][j] = word_database["count"][j] + 1
+                journal_count_deltas[j] = journal_count_deltas.get(j, 0) + 1
 
+                if rag_scoring == "BM25" and not is_setting_up:
+                    calc_word_value(j)
 
+            word_found = True
 
-        i = i + 1
+            # Add to our history word ID database
+            history_word_ids.append(j)
+
+
+        # If word not in database and we are counting, add it in (word will simply be skipped for eval parsing)
+        if not word_found and count_to_total:
+            word_database["word"].append(word_collector)
+            word_database["count"].append(1)
+            word_database["value"].append(0.99)         # Note: will have to be recalculated later on for new words
+            word_index[word_collector] = len(word_database["word"]) - 1
+            journal_count_deltas[len(word_database["word"]) - 1] = 1
+
+            # Add to our history word ID database
+            history_word_ids.append(len(word_database["word"]) - 1)
+
+
+        # Boost our total word count
+        if count_to_total:
+            word_database['total_word_count'] = word_database['total_word_count'] + 1
+            journal_total_delta += 1
 
     # Sent by me, history
     if flag == 0:
@@ -423,42 +761,167 @@ def parse_words_to_database(message, flag):
         return history_word_ids
 
 
+# Merges the word counts from a parallel rebuild into the database. Shards go in order, and each shard's words are in
+# order of first use, so every word gets the exact same ID as counting it all on one thread would give
+def merge_shard_counts(shard_results):
+
+    for local_words, local_counts, me_word_ids, her_word_ids, total_word_count in shard_results:
+
+        # Map this shard's word IDs over to our IDs, adding in any new words
+        id_remap = []
+        for local_id in range(len(local_words)):
+            word_id = word_index.get(local_words[local_id])
+
+            if word_id is None:
+                word_id = len(word_database["word"])
+                word_database["word"].append(local_words[local_id])
+                word_database["count"].append(0)
+                word_database["value"].append(0.99)
+                word_index[local_words[local_id]] = word_id
+
+            word_database["count"][word_id] += local_counts[local_id]
+            id_remap.append(word_id)
+
+        for word_ids in me_word_ids:
+            histories_word_id_database["me"].append([id_remap[local_id] for local_id in word_ids])
+
+        for word_ids in her_word_ids:
+            histories_word_id_database["her"].append([id_remap[local_id] for local_id in word_ids])
+            histories_word_id_database["scores"].append(0)
+
+        word_database['total_word_count'] += total_word_count
+
+
+# Rebuilds the word index from the word database (run whenever the word database gets replaced). Words out in the cold
+# tier are left out, they get found with find_word_id
+def rebuild_word_index():
+    global word_index
+
+    word_index = {}
+
+    i = 0
+    while i < len(word_database["word"]):
+
+        # Keep the first ID, if there are ever any doubled up words
+        if word_database["word"][i] is not None and word_database["word"][i] not in word_index:
+            word_index[word_database["word"][i]] = i
+
+        i = i + 1
+
+
+# Finds the ID of a word, or None if it is new. Words found in the cold tier get brought back into memory if we are
+# writing (under the write lock), searches just look them up and leave the database be
+def find_word_id(word, restore=False):
+
+    word_id = word_index.get(word)
+
+    if word_id is None and utils.rag_binary.cold_tier is not None:
+        word_id = utils.rag_binary.find_cold_word(word)
+
+        if word_id is not None and restore:
+            with rag_write_lock:
+                word_database["word"][word_id] = word
+                word_index[word] = word_id
+
+    return word_id
+
+
+# Gets a word by its ID, reading it from the cold tier if it is not in memory
+def get_word(word_id):
+
+    word = word_database['word'][word_id]
+    if word is None:
+        word = utils.rag_binary.read_cold_word(word_id)
+
+    return word
+
+
+# Moves anything old enough out to the cold tier; history pairs past the hot ones, and words only used once.
+# Only what is already in the saved snapshot can go, as that is where it gets read back from
+def evict_cold_entries():
+    global history_evict_mark, word_evict_mark
+
+    if not rag_memory_budget or utils.rag_binary.cold_tier is None:
+        return
+
+    history_evict_end = min(len(history_database) - rag_hot_history_pairs, utils.rag_binary.cold_tier['pair_count'])
+    while history_evict_mark < history_evict_end:
+        history_database[history_evict_mark] = None
+        history_evict_mark = history_evict_mark + 1
+
+    word_evict_end = utils.rag_binary.cold_tier['word_count']
+    while word_evict_mark < word_evict_end:
+        word = word_database["word"][word_evict_mark]
+
+        # Keep the blank word, it is used for padding
+        if word is not None and word_evict_mark > 0 and word_database["count"][word_evict_mark] <= 1:
+            if word_index.get(word) == word_evict_mark:
+                del word_index[word]
+            word_database["word"][word_evict_mark] = None
+
+        word_evict_mark = word_evict_mark + 1
+
+
+def reset_eviction_marks():
+    global history_evict_mark, word_evict_mark
+
+    history_evict_mark = 0
+    word_evict_mark = 0
+
+
 # Calculates the value of all words
 def calc_word_values():
     global word_database
 
-    # Give base values to all the words, with a maximum score being 1
-    i = 0
-    while i < len(word_database["value"]):
-        word_database['value'][i] = (1 / (word_database['count'][i] + 19)) * 20
-        i = i + 1
+    # Give base values to all the words, with a maximum score being 1 (all at once, kept as a list so it still saves to JSON).
+    # Swapped in as a new list, so a search never sees it half done
+    word_counts = np.asarray(word_database['count'][:len(word_database['value'])], dtype=np.float64)
+    word_database['value'] = ((1 / (word_counts + 19)) * 20).tolist() + word_database['value'][len(word_counts):]
+
+
+
+# Calculates the value of a single word, after its count changes
+def calc_word_value(word_id):
+    word_database['value'][word_id] = (1 / (word_database['count'][word_id] + 19)) * 20
 
 
 
-# Prunes really common words, as there is no need to store these
+# Works out which words are too common, all at once
+def calc_stop_words():
+    global stop_word_ids
+
+    if word_database['total_word_count'] == 0:
+        stop_word_ids = set()
+        return
+
+    word_counts = np.asarray(word_database['count'], dtype=np.int64)
+    stop_word_ids = set(np.flatnonzero((word_counts / word_database['total_word_count']) > stop_word_ratio).tolist())
+
+
+# Prunes really common words, as there is no need to store these (for a newly added pair)
 def prune_common(point):
 
-    global word_database
     global histories_word_id_database
 
-    # Prunes the common words out of the given phrase
-    i = 0
-    while i < len(histories_word_id_database["me"][point]):
-        word_id = histories_word_id_database["me"][point][i]
-        if (word_database['count'][word_id] / word_database['total_word_count']) > 0.000937:
-            histories_word_id_database["me"][point].pop(i)
-            i = 0
+    # Only the words in this pair have had their counts change, so just check over those ones again
+    for word_id in set(histories_word_id_database["me"][point] + histories_word_id_database["her"][point]):
+        if (word_database['count'][word_id] / word_database['total_word_count']) > stop_word_ratio:
+            stop_word_ids.add(word_id)
+        else:
+            stop_word_ids.discard(word_id)
 
-        i = i + 1
+    histories_word_id_database["me"][point] = prune_word_ids(histories_word_id_database["me"][point])
+    histories_word_id_database["her"][point] = prune_word_ids(histories_word_id_database["her"][point])
 
-    i = 0
-    while i < len(histories_word_id_database["her"][point]):
-        word_id = histories_word_id_database["her"][point][i]
-        if (word_database['count'][word_id] / word_database['total_word_count']) > 0.000937:
-            histories_word_id_database["her"][point].pop(i)
-            i = 0
 
-        i = i + 1
+# Gives back the word IDs without the common words, in one pass. Same result as it has always been; if the first word
+# gets pruned, the word that moves up into its place is kept either way
+def prune_word_ids(word_ids):
+
+    if len(word_ids) > 0 and word_ids[0] in stop_word_ids:
+        return word_ids[1:2] + [word_id for word_id in word_ids[2:] if word_id not in stop_word_ids]
+
+    return word_ids[:1] + [word_id for word_id in word_ids[1:] if word_id not in stop_word_ids]
 
 
 # Totals and returns the value of a given message, when tied to keywords
@@ -485,6 +948,414 @@ def evaluate_message(valued_word_ids, hist_word_ids):
     return value
 
 
+# Finds the ID of the best scoring message pair for the given keywords (or 0 if nothing is any good)
+def find_best_message_id(valued_word_ids, snapshot):
+
+    # Disallow message 1, and disallow any recalling from past the demarc. Should be able to recall / flow from there
+    cutoff_id = snapshot['pair_count'] - history_demarc
+
+    search_tags = find_search_tags()
+
+    if rag_scoring == "BM25":
+        pair_scores = filter_tagged_pairs(utils.rag_recency.add_bonuses(utils.rag_bm25.score_pairs(valued_word_ids, snapshot['pair_count'])), search_tags)
+
+        # Only pairs with a keyword in them can be picked, and the latest one wins on a tie
+        best_message_score = 0
+        best_message_id = 0
+
+        for pair_id in pair_scores:
+            if pair_id < 1 or pair_id >= cutoff_id:
+                continue
+
+            if pair_scores[pair_id] > best_message_score or (pair_scores[pair_id] == best_message_score and pair_id > best_message_id):
+                best_message_id = pair_id
+                best_message_score = pair_scores[pair_id]
+
+        return best_message_id
+
+    if rag_backend == "Sparse":
+        pair_scores = utils.rag_recency.add_bonuses_array(utils.rag_sparse.score_pairs(valued_word_ids, len(word_database['word']), snapshot['pair_count']))
+
+        # Pairs outside of our tags can't be picked
+        if search_tags is not None:
+            pair_scores[~tagged_pair_mask(search_tags, len(pair_scores))] = -np.inf
+
+        pair_scores = pair_scores[1:cutoff_id]
+
+        # Nothing below 0 can be picked, and the latest one wins on a tie
+        if len(pair_scores) == 0 or pair_scores.max() < 0:
+            return 0
+
+        return 1 + int(np.flatnonzero(pair_scores == pair_scores.max())[-1])
+
+    # Score only the message pairs that contain our keywords, using the inverted index (or the shards for our tags)
+    pair_scores = utils.rag_recency.add_bonuses(score_tagged_pairs(valued_word_ids, search_tags, snapshot))
+    searched_empty_pair_ids = find_empty_pair_ids(search_tags)
+
+    best_message_score = 0
+    best_message_id = 0
+
+    for pair_id in pair_scores:
+        if pair_id < 1 or pair_id >= cutoff_id:
+            continue
+
+        # Higher ID wins on a tie, so that more recent entries are chosen, if equal
+        if pair_scores[pair_id] > best_message_score or (pair_scores[pair_id] == best_message_score and pair_id > best_message_id):
+            best_message_id = pair_id
+            best_message_score = pair_scores[pair_id]
+
+    # Pairs without any keywords only score 0 if both messages are empty, so they can only win a tie on 0
+    if best_message_score == 0:
+        empty_marker = bisect.bisect_left(searched_empty_pair_ids, cutoff_id) - 1
+        if empty_marker >= 0 and searched_empty_pair_ids[empty_marker] >= 1 and searched_empty_pair_ids[empty_marker] > best_message_id:
+            best_message_id = searched_empty_pair_ids[empty_marker]
+
+    return best_message_id
+
+
+# Finds the best few non-overlapping memory windows for the given keywords, best first (or just window 0 if nothing is any good)
+def find_best_window_ids(valued_word_ids, snapshot):
+
+    cutoff_id = snapshot['pair_count'] - history_demarc
+
+    search_tags = find_search_tags()
+
+    if rag_scoring == "BM25":
+        pair_scores = filter_tagged_pairs(utils.rag_recency.add_bonuses(utils.rag_bm25.score_pairs(valued_word_ids, snapshot['pair_count'])), search_tags)
+
+    elif rag_backend == "Sparse":
+        pair_scores = utils.rag_recency.add_bonuses_array(utils.rag_sparse.score_pairs(valued_word_ids, len(word_database['word']), snapshot['pair_count']))
+        pair_scores = filter_tagged_pairs(dict(enumerate(pair_scores.tolist())), search_tags)
+
+    else:
+        pair_scores = utils.rag_recency.add_bonuses(score_tagged_pairs(valued_word_ids, search_tags, snapshot))
+
+        # Empty pairs score 0 without any keywords, so they can still be picked
+        for pair_id in find_empty_pair_ids(search_tags):
+            pair_scores.setdefault(pair_id, 0)
+
+    return pick_memory_windows(pair_scores, cutoff_id)
+
+
+# Ranks memory windows by the total score of all three of their message pairs, and picks the best ones that don't
+# overlap. Only pairs that scored atleast 0 can be in the middle of a window, and the latest one wins on a tie
+def pick_memory_windows(pair_scores, cutoff_id):
+
+    window_scores = []
+
+    for pair_id in pair_scores:
+        if pair_id < 1 or pair_id >= cutoff_id or pair_scores[pair_id] < 0:
+            continue
+
+        window_score = pair_scores[pair_id] + score_missed_pair(pair_id - 1, pair_scores) + score_missed_pair(pair_id + 1, pair_scores)
+        window_scores.append((window_score, pair_id))
+
+    window_scores.sort(reverse=True)
+
+    window_ids = []
+    for window_score, pair_id in window_scores:
+        if len(window_ids) >= rag_memory_windows:
+            break
+
+        if all(abs(pair_id - window_id) >= 3 for window_id in window_ids):
+            window_ids.append(pair_id)
+
+    if len(window_ids) == 0:
+        window_ids.append(0)
+
+    return window_ids
+
+
+# Gets the score of a message pair, even if it wasn't scored for having none of the keywords
+def score_missed_pair(pair_id, pair_scores):
+
+    if pair_id in pair_scores:
+        return pair_scores[pair_id]
+
+    me_word_ids = histories_word_id_database['me']
+    her_word_ids = histories_word_id_database['her']
+
+    if rag_scoring == "BM25" or rag_engine == "Embedding" or pair_id >= min(len(me_word_ids), len(her_word_ids)):
+        return 0
+
+    # Same as evaluate_message, with no keyword hits
+    return max(-(len(me_word_ids[pair_id]) / 115), -1) + max(-(len(her_word_ids[pair_id]) / 115), -1)
+
+
+# Scores all message pairs that contain any of the given keywords (same scoring as evaluate_message, per pair), using
+# the given inverted index (the main one, or a tag shard). Only the pairs in the read snapshot get scored
+def score_message_pairs(valued_word_ids, postings, snapshot):
+
+    # Count the keyword hits for each side of each message pair
+    me_hits = {}
+    her_hits = {}
+
+    for word_id in valued_word_ids:
+        for pair_id in get_word_pair_ids(postings, 'me', word_id):
+            me_hits[pair_id] = me_hits.get(pair_id, 0) + 1
+        for pair_id in get_word_pair_ids(postings, 'her', word_id):
+            her_hits[pair_id] = her_hits.get(pair_id, 0) + 1
+
+    pair_scores = {}
+
+    for pair_id in set(me_hits) | set(her_hits):
+        if pair_id >= snapshot['pair_count']:
+            continue
+
+        me_value = me_hits.get(pair_id, 0) - (len(snapshot['me'][pair_id]) / 115)
+        if me_value < -1:
+            me_value = -1
+
+        her_value = her_hits.get(pair_id, 0) - (len(snapshot['her'][pair_id]) / 115)
+        if her_value < -1:
+            her_value = -1
+
+        pair_scores[pair_id] = me_value + her_value
+
+    return pair_scores
+
+
+# Adds a message pair to the inverted index (must be the newest one)
+def add_pair_to_postings(point):
+    index_pair_words(point, word_postings)
+
+
+# Removes a message pair from the inverted index (must be the newest one)
+def remove_pair_from_postings(point):
+    unindex_pair_words(point, word_postings)
+
+
+# The message pairs a word is in, for one side of the given inverted index. Read from the saved index if it has not been
+# touched since loading
+def get_word_pair_ids(postings, side, word_id):
+
+    word_pair_ids = postings[side].get(word_id)
+
+    if word_pair_ids is None:
+        if postings.get('saved') is None:
+            return []
+        word_pair_ids = utils.rag_binary.read_saved_pair_ids(postings['saved'], side, word_id)
+
+    return word_pair_ids
+
+
+# Same, but for changing; brings the word's pairs out of the saved index and into memory first
+def take_word_pair_ids(postings, side, word_id):
+
+    if word_id not in postings[side]:
+        postings[side][word_id] = get_word_pair_ids(postings, side, word_id)
+
+    return postings[side][word_id]
+
+
+# Adds a message pair's words to the given inverted index (the main one, or a tag shard)
+def index_pair_words(point, postings):
+
+    for side in ['me', 'her']:
+        for word_id in set(histories_word_id_database[side][point]):
+            take_word_pair_ids(postings, side, word_id).append(point)
+
+    if len(histories_word_id_database['me'][point]) == 0 and len(histories_word_id_database['her'][point]) == 0:
+        postings['empty'].append(point)
+
+
+# Takes a message pair's words back out of the given inverted index (must be the newest one in it). Word lists may get
+# shorter under a search, which is fine as it is past the read snapshot, but the empty pairs get searched by position,
+# so they get swapped for a shorter copy
+def unindex_pair_words(point, postings):
+
+    for side in ['me', 'her']:
+        for word_id in set(histories_word_id_database[side][point]):
+            word_pair_ids = take_word_pair_ids(postings, side, word_id)
+            if word_pair_ids and word_pair_ids[-1] == point:
+                word_pair_ids.pop()
+
+                # (kept empty if there is a saved index, so it doesn't get read from there again)
+                if len(word_pair_ids) == 0 and postings.get('saved') is None:
+                    del postings[side][word_id]
+
+    if len(postings['empty']) > 0 and postings['empty'][-1] == point:
+        postings['empty'] = postings['empty'][:-1]
+
+
+# Adds a message pair to the shard of each of its tags (must be the newest one)
+def add_pair_to_tag_shards(point):
+    index_pair_tags(point, tag_shards, pair_tags)
+
+
+# Adds a message pair to the given tag shards, and notes its tags
+def index_pair_tags(point, shards, tags_by_pair):
+
+    tags = []
+    history = get_history_pair(point)
+    if len(history) > 2 and isinstance(history[2], list):
+        tags = list(dict.fromkeys(tag for tag in history[2] if isinstance(tag, str)))
+
+    for tag in tags:
+        shard = shards.setdefault(tag, {'me': {}, 'her': {}, 'empty': [], 'pairs': []})
+        index_pair_words(point, shard)
+        shard['pairs'].append(point)
+
+    tags_by_pair.append(tags)
+
+
+# Removes the newest message pair from the tag shards
+def remove_pair_from_tag_shards(point):
+    global pair_tags
+
+    if len(pair_tags) <= point:
+        return
+
+    for tag in pair_tags[-1]:
+        unindex_pair_words(point, tag_shards[tag])
+        if len(tag_shards[tag]['pairs']) > 0 and tag_shards[tag]['pairs'][-1] == point:
+            tag_shards[tag]['pairs'].pop()
+
+    pair_tags = pair_tags[:-1]
+
+
+# Rebuilds all of the tag shards from scratch (then swaps them in, so searches never see them half done)
+def rebuild_tag_shards():
+    global tag_shards, pair_tags
+
+    shards = {}
+    tags_by_pair = []
+
+    if rag_tag_shards:
+        i = 0
+        while i < len(histories_word_id_database['me']):
+            index_pair_tags(i, shards, tags_by_pair)
+            i = i + 1
+
+    tag_shards = shards
+    pair_tags = tags_by_pair
+
+
+# The tags to search within, the current ones that have a shard. None means search everything
+def find_search_tags():
+
+    if not rag_tag_shards:
+        return None
+
+    search_tags = [tag for tag in dict.fromkeys(utils.tag_task_controller.apply_tags()) if tag in tag_shards]
+
+    if len(search_tags) == 0:
+        return None
+
+    return search_tags
+
+
+# Scores the message pairs for the given keywords, in the shards of the given tags (or everything, for None). A pair can
+# be in more than one shard, it just scores the same in each
+def score_tagged_pairs(valued_word_ids, search_tags, snapshot):
+
+    if search_tags is None:
+        return score_message_pairs(valued_word_ids, word_postings, snapshot)
+
+    pair_scores = {}
+    for tag in search_tags:
+        pair_scores.update(score_message_pairs(valued_word_ids, tag_shards[tag], snapshot))
+
+    return pair_scores
+
+
+# The empty message pairs in the shards of the given tags (or everything, for None), in order
+def find_empty_pair_ids(search_tags):
+
+    if search_tags is None:
+        return word_postings['empty']
+
+    if len(search_tags) == 1:
+        return tag_shards[search_tags[0]]['empty']
+
+    return sorted(set(pair_id for tag in search_tags for pair_id in tag_shards[tag]['empty']))
+
+
+# Drops any pairs that aren't in the shards of the given tags (for the backends that don't search by shard)
+def filter_tagged_pairs(pair_scores, search_tags):
+
+    if search_tags is None:
+        return pair_scores
+
+    tags_by_pair = pair_tags
+
+    return {pair_id: pair_scores[pair_id] for pair_id in pair_scores
+            if pair_id < len(tags_by_pair) and not set(tags_by_pair[pair_id]).isdisjoint(search_tags)}
+
+
+# Which pairs are in the shards of the given tags, as a mask over all of them
+def tagged_pair_mask(search_tags, pair_count):
+
+    mask = np.zeros(pair_count, dtype=bool)
+
+    for tag in search_tags:
+        shard_pair_ids = np.asarray(tag_shards[tag]['pairs'], dtype=np.int64)
+        mask[shard_pair_ids[shard_pair_ids < pair_count]] = True
+
+    return mask
+
+
+# Rebuilds the search index for whichever backend we are using (run whenever the history word IDs get replaced). On
+# load, the inverted index can come from the saved one instead
+def rebuild_search_index(from_saved=False):
+
+    if rag_scoring == "BM25":
+        utils.rag_bm25.build_stats(histories_word_id_database)
+    elif rag_backend == "Sparse":
+        utils.rag_sparse.build_matrix(histories_word_id_database)
+    elif not (from_saved and load_word_postings()):
+        rebuild_word_postings()
+
+    utils.rag_recency.build_bonuses(len(histories_word_id_database['me']), get_history_pair)
+    rebuild_tag_shards()
+
+
+# Rebuilds the inverted index from the history word IDs (then swaps it in, so searches never see it half done)
+def rebuild_word_postings():
+    global word_postings
+
+    postings = {
+        'me': {},
+        'her': {},
+        'empty': [],
+        'saved': None
+    }
+
+    i = 0
+    while i < len(histories_word_id_database['me']):
+        index_pair_words(i, postings)
+        i = i + 1
+
+    word_postings = postings
+
+
+# Uses the inverted index saved with the snapshot we loaded, just indexing the pairs added from the journal after it.
+# Gives back False if it can't be used (none saved, or the journal undid pairs from before it), to rebuild instead
+def load_word_postings():
+    global word_postings
+
+    saved_postings = utils.rag_binary.saved_postings
+
+    if saved_postings is None or saved_postings['pair_count'] > len(histories_word_id_database['me']):
+        return False
+
+    postings = {
+        'me': {},
+        'her': {},
+        'empty': saved_postings['empty'].tolist(),
+        'saved': saved_postings
+    }
+
+    i = saved_postings['pair_count']
+    while i < len(histories_word_id_database['me']):
+        index_pair_words(i, postings)
+        i = i + 1
+
+    word_postings = postings
+
+    return True
+
+
 # Adds messages to the database once it becomes validated (on next message send)
 def add_message_to_database():
 
@@ -492,9 +1363,27 @@ def add_message_to_database():
     if not utils.settings.rag_enabled:
         return
 
+    # Let any speculative search finish up first (unless we are it)
+    wait_for_speculative_rag()
+
+    with rag_write_lock:
+        add_latest_message()
+        publish_read_snapshot()
+
+
+# Adds in the latest message pair from the chat history (under the write lock)
+def add_latest_message():
+
     # Import History
     history = API.api_controller.ooga_history
-    global word_database, manual_recalculate_ignore_latest, history_database
+    global word_database, manual_recalculate_ignore_latest, history_database, last_added_history_mark, rag_database_generation
+
+    # Do not run twice on the same history (the speculative search may have already added it in)
+    history_mark = [len(history), history[-1][0], history[-1][1]]
+    if history_mark == last_added_history_mark:
+        return
+
+    last_added_history_mark = history_mark
 
     # Do not add in if we just manually re-calculated, it is already in there
     if manual_recalculate_ignore_latest:
@@ -504,7 +1393,7 @@ def add_message_to_database():
     new_msg = len(history) - 1
 
     # Do not add in if the content is the same as the last message (likely bugged / undo)
-    if (history[new_msg][0] + history[new_msg][1]) == (history_database[-1][0] + history_database[-1][1]):
+    if (history[new_msg][0] + history[new_msg][1]) == (get_history_pair(-1)[0] + get_history_pair(-1)[1]):
         utils.zw_logging.update_debug_log("Preventing dupe in RAG!")
         return
 
@@ -517,12 +1406,71 @@ def add_message_to_database():
     parse_words_to_database(history[new_msg][0], 0)
     parse_words_to_database(history[new_msg][1], 1)
 
-    history_database += [[history[new_msg][0], history[new_msg][1]]]
+    history_database += [[history[new_msg][0], history[new_msg][1]] + history[new_msg][2:]]
 
 
     # Prune these as well (always latest one, may not sync 1:1 to history due to system messages)
     prune_common(len(histories_word_id_database['me']) - 1)
 
+    # Anything searched before is out of date now
+    rag_database_generation += 1
+
+    # Embed it, if we are recalling by meaning
+    if rag_engine == "Embedding":
+        utils.rag_embed.add_pair(history_database[-1])
+
+    # Index it for searching (BM25 only updates the stats of this pair's words here)
+    if rag_scoring == "BM25":
+        utils.rag_bm25.add_pair(histories_word_id_database['me'][-1], histories_word_id_database['her'][-1])
+    elif rag_backend == "Sparse":
+        utils.rag_sparse.append_row(histories_word_id_database['me'][-1], histories_word_id_database['her'][-1])
+    else:
+        add_pair_to_postings(len(histories_word_id_database['me']) - 1)
+
+    utils.rag_recency.add_pair(history_database[-1])
+
+    if rag_tag_shards:
+        add_pair_to_tag_shards(len(histories_word_id_database['me']) - 1)
+
+    # Journal it, for saving
+    journal_pending_records.append({'op': "add", 'me': histories_word_id_database['me'][-1], 'her': histories_word_id_database['her'][-1],
+                                    'history': history_database[-1]})
+
+
+
+# Gives the newest message pair in the database new tags (like when it gets pinned), if it is the given pair. If the
+# database hasn't taken the pair in yet, it just gets the new tags when it does
+def update_latest_pair_tags(message_pair):
+    global rag_database_generation
+
+    # Blocking statement to stop if our RAG is not enabled
+    if not utils.settings.rag_enabled:
+        return
+
+    with rag_write_lock:
+        pair_id = len(histories_word_id_database['me']) - 1
+        if pair_id < 0:
+            return
+
+        history = get_history_pair(pair_id)
+        if history[0] != message_pair[0] or history[1] != message_pair[1]:
+            return
+
+        history_database[pair_id] = [history[0], history[1]] + message_pair[2:]
+
+        utils.rag_recency.set_pair_pinned(pair_id, history_database[pair_id])
+
+        if rag_tag_shards:
+            remove_pair_from_tag_shards(pair_id)
+            add_pair_to_tag_shards(pair_id)
+
+        # Anything searched before is out of date now
+        rag_database_generation += 1
+        publish_read_snapshot()
+
+        # Journal it, for saving
+        journal_pending_records.append({'op': "tags", 'pair': pair_id, 'history': history_database[pair_id]})
+
 
 
 # Remove last entry in the database (undo)
@@ -536,11 +1484,40 @@ def remove_latest_database_message():
     # NOTE: Does NOT uncount words! This should mostly be fine in the large scale, and we still have manual recalcs that can self right this
     #
 
-    global histories_word_id_database
+    wait_for_speculative_rag()
+
+    with rag_write_lock:
+        remove_latest_message()
+        publish_read_snapshot()
+
+
+# Takes the latest message pair back out (under the write lock). The word ID lists get swapped for shorter copies,
+# rather than popped, as a search may still be going over them
+def remove_latest_message():
+    global rag_database_generation
+
+    rag_database_generation += 1
+
+    # Unindex it first, while we still know what words it had
+    if rag_scoring == "BM25":
+        utils.rag_bm25.pop_pair(histories_word_id_database['me'][-1], histories_word_id_database['her'][-1])
+    elif rag_backend == "Sparse":
+        utils.rag_sparse.pop_row()
+    else:
+        remove_pair_from_postings(len(histories_word_id_database["me"]) - 1)
+
+    utils.rag_recency.pop_pair()
+    remove_pair_from_tag_shards(len(histories_word_id_database["me"]) - 1)
+
+    histories_word_id_database["me"] = histories_word_id_database["me"][:-1]
+    histories_word_id_database["her"] = histories_word_id_database["her"][:-1]
+    histories_word_id_database["scores"] = histories_word_id_database["scores"][:-1]
+
+    if rag_engine == "Embedding":
+        utils.rag_embed.pop_pair()
 
-    histories_word_id_database["me"].pop()
-    histories_word_id_database["her"].pop()
-    histories_word_id_database["scores"].pop()
+    # Journal it, for saving
+    journal_pending_records.append({'op': "undo"})
 
 
 
@@ -550,15 +1527,52 @@ def store_rag_history():
     if not utils.settings.rag_enabled:
         return
 
-    # Save, Export to JSON
-    with open("RAG_Database/LiveRAG_Words.json", 'w') as outfile:
-        json.dump(word_database, outfile, indent=4)
+    global journal_snapshot_needed
+
+    # Nothing gets added while we save
+    with rag_write_lock:
+
+        # Save the embeddings (only if they changed)
+        if rag_engine == "Embedding":
+            utils.rag_embed.save_index()
+
+        # Save a full snapshot, if we have rebuilt everything
+        if journal_snapshot_needed:
+            utils.rag_binary.save_database(word_database, histories_word_id_database, history_database)
+            journal_snapshot_needed = False
+            clear_journal_tracking()
+            evict_cold_entries()
+            return
 
-    with open("RAG_Database/LiveRAG_HistoryWordID.json", 'w') as outfile:
-        json.dump(histories_word_id_database, outfile, indent=4)
+        # Otherwise just append what has changed since last time to the journal, word changes first
+        records = []
 
-    with open("RAG_Database/LiveRAG_History.json", 'w') as outfile:
-        json.dump(history_database, outfile, indent=4)
+        if len(word_database['word']) > journal_word_mark or len(journal_count_deltas) > 0 or journal_total_delta != 0:
+            records.append({'op': "words", 'new': word_database['word'][journal_word_mark:],
+                            'counts': [[word_id, journal_count_deltas[word_id]] for word_id in journal_count_deltas],
+                            'total': journal_total_delta})
+
+        records += journal_pending_records
+
+        utils.rag_binary.append_journal(records)
+        clear_journal_tracking()
+
+        # Fold the journal into a new snapshot every so often (in the background)
+        if utils.rag_binary.journal_needs_compacting():
+            utils.rag_binary.start_compaction(word_database, histories_word_id_database, history_database)
+
+        # Anything the last snapshot covers can go out to the cold tier now
+        evict_cold_entries()
+
+
+# Clears out the tracked changes, once they are saved
+def clear_journal_tracking():
+    global journal_pending_records, journal_word_mark, journal_count_deltas, journal_total_delta
+
+    journal_pending_records = []
+    journal_word_mark = len(word_database['word'])
+    journal_count_deltas = {}
+    journal_total_delta = 0
 
 
 def load_rag_history():
@@ -567,34 +1581,60 @@ def load_rag_history():
     if not utils.settings.rag_enabled:
         return
 
-    global word_database, histories_word_id_database, history_database, is_setting_up
+    with rag_write_lock:
+        load_or_setup_database()
+        publish_read_snapshot()
 
-    # Check if we need to load, or generate the RAG
-    path = 'RAG_Database/LiveRAG_Words.json'
-    path2 = 'RAG_Database/LiveRAG_HistoryWordID.json'
-    path3 = 'RAG_Database/LiveRAG_History.json'
 
-    check_file = os.path.isfile(path)
-    check_file2 = os.path.isfile(path2)
-    check_file3 = os.path.isfile(path3)
+# Loads the database, migrates it from the old JSON, or generates it (under the write lock)
+def load_or_setup_database():
+    global word_database, histories_word_id_database, history_database, is_setting_up, rag_database_generation
 
+    # Anything searched before is out of date now
+    rag_database_generation += 1
 
-    # Switch
-    if check_file and check_file2 and check_file3:
+    # Loaded history text is read from the saved snapshot as needed, so always keep it open
+    utils.rag_binary.use_cold_tier = True
+    reset_eviction_marks()
+
+    # Switch, check if we need to load, migrate from the old JSON, or generate the RAG
+    if utils.rag_binary.binary_database_exists():
 
         # File found, load
 
         if show_rag_debug:
             utils.zw_logging.update_rag_log("\nLoading RAG from pervious session!\n")
 
-        with open(path, 'r') as openfile:
-            word_database = json.load(openfile)
+        if rag_memory_budget:
+            word_database, histories_word_id_database, history_database = utils.rag_binary.load_database(rag_hot_history_pairs, True)
+        else:
+            word_database, histories_word_id_database, history_database = utils.rag_binary.load_database()
+
+        rebuild_word_index()
+        rebuild_search_index(from_saved=True)
+        clear_journal_tracking()
+        load_embedding_index()
+        load_stop_words()
+        evict_cold_entries()
+
+        # Flag this as done
+        is_setting_up = False
+
+    elif utils.rag_binary.json_database_exists():
 
-        with open(path2, 'r') as openfile:
-            histories_word_id_database = json.load(openfile)
+        # Old JSON files found, load them and convert them over (one time only)
 
-        with open(path3, 'r') as openfile:
-            history_database = json.load(openfile)
+        print("\nConverting the RAG database to the new binary format...\n")
+        utils.zw_logging.update_rag_log("\nConverting the RAG database to the new binary format...\n")
+
+        word_database, histories_word_id_database, history_database = utils.rag_binary.load_and_retire_json_database()
+
+        rebuild_word_index()
+        rebuild_search_index()
+        clear_journal_tracking()
+        load_embedding_index()
+        load_stop_words()
+        evict_cold_entries()
 
         # Flag this as done
         is_setting_up = False
@@ -606,13 +1646,40 @@ def load_rag_history():
         manual_recalculate_database()
 
 
+# Loads the embeddings for the message pairs, embedding any that are missing (only if we are recalling by meaning)
+def load_embedding_index():
+
+    if rag_engine != "Embedding":
+        return
+
+    # Only as many pairs as are searchable (undo takes pairs out of the search, but not out of the history)
+    pair_count = len(histories_word_id_database['me'])
+
+    with tqdm(total=pair_count, file=sys.stdout) as progress_bar:
+        utils.rag_embed.load_index(pair_count, get_history_pair, progress_bar)
+
+
+# Works out the common words for the loaded database, letting us know if it was pruned with a different ratio than now
+def load_stop_words():
+
+    word_database.setdefault('stop_word_ratio', 0.000937)
+    calc_stop_words()
+
+    if word_database['stop_word_ratio'] != stop_word_ratio:
+        print("\nThe RAG database was pruned with a stop word ratio of " + str(word_database['stop_word_ratio'])
+              + ", new messages will use " + str(stop_word_ratio) + ". Manually recalculate the RAG to apply it to everything!\n")
+        utils.zw_logging.update_rag_log("Stop word ratio changed, from " + str(word_database['stop_word_ratio']) + " to " + str(stop_word_ratio))
+
+
 def manual_recalculate_database():
 
     # All in one
 
     print("\nManually re-calculating the RAG database. Give me some time...\n")
     utils.zw_logging.update_rag_log("\nManually re-calculating the RAG database. Give me some time...\n")
-    setup_based_rag()
+
+    with rag_write_lock:
+        setup_based_rag()
 
 
 def word_value_passive_calculation():
@@ -624,5 +1691,11 @@ def word_value_passive_calculation():
         time.sleep(120)
 
         if not is_setting_up:
-            calc_word_values()
+            with rag_write_lock:
+                calc_word_values()
+
 
+# Index the starting words
+rebuild_word_index()
+clear_journal_tracking()
+publish_read_snapshot()
@@ -1,10 +1,14 @@
 import utils.cane_lib
 import json
 import utils.zw_logging
+import utils.tokenizer
 
 do_log_lore = True
 total_lore_default = "Here is some lore about the current topics from your lorebook, please reference them;\n\n"
 
+# Single word lore entries, as the RAG sees them (worked out on first use)
+lore_rag_words = None
+
 
 # Load the LORE_BOOK, it is now JSON configurable!
 with open("Configurables/Lorebook.json", 'r') as openfile:
@@ -53,11 +57,11 @@ def lorebook_gather(messages, sent_message):
 
     # Search every lore entry for each of the messages, and add the lore as needed
     for message in reformed_messages:
-        # Search for new ones
+        message_words = utils.tokenizer.split_words(message)
+
+        # Search for new ones (the whole word, or with an "s" on the end)
         for lore in LORE_BOOK:
-            if utils.cane_lib.keyword_check(message, [" " + lore['0'] + " ", " " + lore['0'] + "\'", " " + lore['0'] + "s",
-                                                      " " + lore['0'] + "!", " " + lore['0'] + ".", " " + lore['0'] + ",", " " + lore['0'] + "?",
-                                                      ]) and lore['2'] == 0:
+            if lore['2'] == 0 and utils.tokenizer.contains_phrase(message_words, lore['0'], allow_plural=True):
 
                 total_lore += (lore['0'] + ", " + lore['1'] + "\n\n")
                 lore['2'] = 7   # lore has procced, prevent dupes
@@ -72,10 +76,15 @@ def lorebook_gather(messages, sent_message):
 
 # Check if keyword is in the lorebook
 def rag_word_check(word):
-    # Lockout clearing
-    for lore in LORE_BOOK:
-        if str.lower(lore['0']) == word:
-            return True
+    global lore_rag_words
+
+    # Work out the lore words the same way the RAG does, once
+    if lore_rag_words is None:
+        lore_rag_words = set()
+        for lore in LORE_BOOK:
+            lore_words = utils.tokenizer.split_rag_words(lore['0'])
+            if len(lore_words) == 1:
+                lore_rag_words.add(lore_words[0])
 
-    return False
+    return word in lore_rag_words
 
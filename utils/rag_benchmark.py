@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import numpy as np
+
+#
+# Benchmark for the BASED RAG, run from the main folder with "python -m utils.rag_benchmark". Makes up chat histories
+# with a Zipfian vocabulary (a few words used all the time, lots used rarely, like real chats), then times setting up,
+# searching, adding, saving and loading the RAG on them, and reports it all as JSON.
+#
+# Each size runs on its own, in a fresh process, in a temporary folder (your own RAG database and logs are never touched).
+# It needs no LLM or the rest of the app, so it runs anywhere, for catching slowdowns or memory creep offline.
+#
+# Example; python -m utils.rag_benchmark --sizes 1000,10000 --output benchmark.json
+#
+
+# Defaults
+benchmark_sizes = [1000, 10000, 100000, 1000000]
+vocabulary_size = 50000
+zipf_exponent = 1.07
+message_word_range = [2, 30]
+query_count = 200
+add_count = 200
+
+
+# Makes up a chat history; message pairs with words drawn from a Zipfian vocabulary (seeded, so it is the same each run)
+def make_synthetic_history(pair_count, seed=0):
+
+    random_generator = np.random.default_rng(seed)
+
+    vocabulary = np.array([make_word(rank) for rank in range(vocabulary_size)], dtype=object)
+    word_chances = 1 / np.arange(1, vocabulary_size + 1, dtype=np.float64) ** zipf_exponent
+    word_chances /= word_chances.sum()
+
+    message_lengths = random_generator.integers(message_word_range[0], message_word_range[1], size=pair_count * 2)
+    all_words = vocabulary[random_generator.choice(vocabulary_size, size=int(message_lengths.sum()), p=word_chances)]
+    endings = random_generator.choice(["", ".", "!", "?", "..."], size=pair_count * 2)
+
+    messages = []
+    word_marker = 0
+    for message_length, ending in zip(message_lengths.tolist(), endings.tolist()):
+        messages.append(" ".join(all_words[word_marker:word_marker + message_length]) + ending)
+        word_marker += message_length
+
+    return [[messages[i * 2], messages[(i * 2) + 1]] for i in range(pair_count)]
+
+
+# Turns a word rank into a made up word ("a", "b", ... "z", "ba", "bb", ...)
+def make_word(rank):
+
+    word = ""
+    while True:
+        word = chr(ord("a") + (rank % 26)) + word
+        rank = rank // 26
+        if rank == 0:
+            return word
+
+
+# Peak memory of this process so far, in MB (None if the system can't tell us)
+def peak_rss_mb():
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux gives it in KB, Mac in bytes
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+
+    return round(peak / 1024, 1)
+
+
+# Times a step, and its peak traced memory if we are tracing. Adds the results to the given dict under the name
+def time_step(results, name, step, item_count=None, item_name="items"):
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    start_time = time.perf_counter()
+    step()
+    seconds = time.perf_counter() - start_time
+
+    step_results = {'seconds': round(seconds, 4)}
+
+    if item_count is not None:
+        step_results[item_name] = item_count
+        step_results[item_name + '_per_second'] = round(item_count / seconds, 2) if seconds > 0 else None
+
+    if tracemalloc.is_tracing():
+        step_results['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+
+    step_results['peak_rss_mb'] = peak_rss_mb()
+
+    results[name] = step_results
+
+
+# Runs every step for one size of history, in this process. Must be started from the main folder
+def run_single_benchmark(pair_count, options):
+
+    results = {'pairs': pair_count}
+    repo_folder = os.getcwd()
+
+    # The RAG only needs the chat history from the API, so stand in for it (the real one starts up the whole app)
+    api_package = types.ModuleType("API")
+    api_package.__path__ = []
+    api_controller = types.ModuleType("API.api_controller")
+    api_controller.ooga_history = []
+    api_package.api_controller = api_controller
+    sys.modules["API"] = api_package
+    sys.modules["API.api_controller"] = api_controller
+
+    import utils.settings
+    import utils.based_rag
+    import utils.rag_binary
+
+    utils.settings.rag_enabled = True
+    utils.based_rag.show_rag_debug = False
+    utils.based_rag.char_name = os.environ.get("CHAR_NAME", "Waifu")
+    utils.based_rag.rag_backend = options.backend
+    utils.based_rag.rag_scoring = options.scoring
+    utils.based_rag.rag_memory_budget = options.memory_budget
+
+    # Make up the history, plus the pairs to add after
+    start_time = time.perf_counter()
+    history = make_synthetic_history(pair_count + options.adds, seed=options.seed)
+    new_pairs = history[pair_count:]
+    history = history[:pair_count]
+    results['generate_seconds'] = round(time.perf_counter() - start_time, 4)
+
+    work_folder = tempfile.mkdtemp(prefix="zw_rag_benchmark_")
+
+    try:
+        os.makedirs(os.path.join(work_folder, "Logs"))
+        os.makedirs(os.path.join(work_folder, "RAG_Database"))
+        os.chdir(work_folder)
+
+        # All but the last couple pairs go in as an old chat log, the rest as the current chat
+        with open("Logs/ChatLog-Benchmark.json", 'w') as outfile:
+            json.dump(history[:-2], outfile)
+
+        api_controller.ooga_history = history[-2:]
+        del history
+
+        if options.trace_memory:
+            tracemalloc.start()
+
+        random.seed(options.seed)
+
+        time_step(results, 'setup_based_rag', utils.based_rag.setup_based_rag, pair_count, "pairs")
+        time_step(results, 'store_rag_history_snapshot', utils.based_rag.store_rag_history)
+
+        # Search with more made up pairs, as what I said and her last reply
+        queries = make_synthetic_history(options.queries, seed=options.seed + 1)
+        query_seconds = []
+
+        def run_queries():
+            for message, her_previous in queries:
+                query_start_time = time.perf_counter()
+                utils.based_rag.run_based_rag(message, her_previous)
+                query_seconds.append(time.perf_counter() - query_start_time)
+
+        time_step(results, 'run_based_rag', run_queries, options.queries, "queries")
+        if len(query_seconds) > 0:
+            results['run_based_rag']['p50_ms'] = round(float(np.percentile(query_seconds, 50)) * 1000, 3)
+            results['run_based_rag']['p95_ms'] = round(float(np.percentile(query_seconds, 95)) * 1000, 3)
+
+        # Add new pairs one at a time, as they would come in from chatting
+        def add_messages():
+            for new_pair in new_pairs:
+                api_controller.ooga_history.append(new_pair)
+                utils.based_rag.add_message_to_database()
+
+        time_step(results, 'add_message_to_database', add_messages, len(new_pairs), "pairs")
+        time_step(results, 'store_rag_history_journal', utils.based_rag.store_rag_history)
+
+        # Let any background compaction finish first, loading is done on boot when there is none going
+        while utils.rag_binary.is_compacting:
+            time.sleep(0.05)
+
+        time_step(results, 'load_rag_history', utils.based_rag.load_rag_history, pair_count + len(new_pairs), "pairs")
+
+        if options.trace_memory:
+            tracemalloc.stop()
+
+        results['words'] = len(utils.based_rag.word_database['word'])
+        results['peak_rss_mb'] = peak_rss_mb()
+
+    finally:
+        os.chdir(repo_folder)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return results
+
+
+# Starts the report, with what we are running on and the settings used (the results get added per size)
+def make_report(options):
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'backend': options.backend,
+            'scoring': options.scoring,
+            'memory_budget': options.memory_budget,
+            'vocabulary_size': vocabulary_size,
+            'zipf_exponent': zipf_exponent,
+            'queries': options.queries,
+            'adds': options.adds,
+            'seed': options.seed,
+            'trace_memory': options.trace_memory
+        },
+        'results': []
+    }
+
+
+# Runs one size in its own process (so the memory peaks and module state don't carry over), and gives back its results
+def run_benchmark_process(pair_count, options):
+
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    result_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    result_file.close()
+
+    command = [sys.executable, "-m", "utils.rag_benchmark", "--single", str(pair_count), "--result-file", result_file.name,
+               "--backend", options.backend, "--scoring", options.scoring, "--queries", str(options.queries),
+               "--adds", str(options.adds), "--seed", str(options.seed)]
+    if options.memory_budget:
+        command.append("--memory-budget")
+    if options.trace_memory:
+        command.append("--trace-memory")
+
+    if options.verbose:
+        completed = subprocess.run(command, cwd=repo_folder)
+    else:
+        completed = subprocess.run(command, cwd=repo_folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    try:
+        if completed.returncode == 0:
+            with open(result_file.name, 'r') as openfile:
+                return json.load(openfile)
+
+        error = "Exited with code " + str(completed.returncode)
+        if completed.stderr:
+            error += "; " + completed.stderr.strip().splitlines()[-1]
+        return {'pairs': pair_count, 'error': error}
+
+    finally:
+        os.remove(result_file.name)
+
+
+def parse_options(arguments=None):
+
+    parser = argparse.ArgumentParser(description="Benchmarks the BASED RAG on made up chat histories, reporting as JSON.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in benchmark_sizes),
+                        help="Comma separated message pair counts to run (default: 1000,10000,100000,1000000)")
+    parser.add_argument("--queries", type=int, default=query_count, help="How many searches to time")
+    parser.add_argument("--adds", type=int, default=add_count, help="How many new message pairs to add one at a time")
+    parser.add_argument("--backend", default="Index", choices=["Index", "Sparse"], help="RAG_BACKEND to use")
+    parser.add_argument("--scoring", default="Classic", choices=["Classic", "BM25"], help="RAG_SCORING to use")
+    parser.add_argument("--memory-budget", action="store_true", help="Run with RAG_MEMORY_BUDGET on")
+    parser.add_argument("--trace-memory", action="store_true", help="Also trace the peak Python memory of each step (slower)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the made up history and searches")
+    parser.add_argument("--output", default=None, help="File to write the JSON to (default: print it)")
+    parser.add_argument("--verbose", action="store_true", help="Show the RAG's own output while it runs")
+    parser.add_argument("--single", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", default=None, help=argparse.SUPPRESS)
+
+    options = parser.parse_args(arguments)
+    options.sizes = [int(size) for size in options.sizes.split(",") if size.strip() != ""]
+
+    return options
+
+
+# Run from the command line, never on import
+if __name__ == "__main__":
+
+    options = parse_options()
+
+    # Worker for a single size
+    if options.single is not None:
+        results = run_single_benchmark(options.single, options)
+        with open(options.result_file, 'w') as outfile:
+            json.dump(results, outfile)
+        sys.exit(0)
+
+    report = make_report(options)
+
+    for pair_count in options.sizes:
+        print("Benchmarking the RAG with " + str(pair_count) + " message pairs...", file=sys.stderr)
+        report['results'].append(run_benchmark_process(pair_count, options))
+
+    report = json.dumps(report, indent=4)
+
+    if options.output is None:
+        print(report)
+    else:
+        with open(options.output, 'w') as outfile:
+            outfile.write(report)
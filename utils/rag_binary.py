@@ -0,0 +1,682 @@
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+import numpy as np
+import utils.zw_logging
+
+#
+# Compact binary storage for the BASED RAG database. Way smaller and faster than the old pretty-printed JSON.
+# Numbers are stored as raw NumPy arrays, and text is stored as one UTF-8 blob with an array of offsets into it,
+# so everything can be memory-mapped on load instead of parsed. The inverted word index gets saved along with it, so it
+# doesn't need rebuilding on load; each word's message pairs get read out of it the first time they are needed.
+#
+# Each full save (snapshot) goes in its own folder, and the meta file points at the current one. Changes between
+# snapshots are appended to a journal, one JSON line per change, so saving after each message only writes what is new.
+# Every so often the journal gets folded into a fresh snapshot in the background (compaction).
+#
+# The current snapshot doubles as a cold tier. History text is left in it on load (memory-mapped, so the OS pages it in
+# and out as it likes) and gets read back by offset when it is needed. In memory budget mode, rare words are left in it
+# too, and older history gets sent back out to it as the chat goes on.
+#
+
+rag_folder = "RAG_Database/"
+
+# Bump this if the layout ever changes
+binary_format_version = 2
+
+meta_file = "LiveRAG_Meta.json"
+snapshot_folder_prefix = "LiveRAG_Snapshot_"
+journal_file_prefix = "LiveRAG_Journal_"
+
+# Compact the journal into a new snapshot once it has this many records
+journal_compact_limit = 200
+
+# The current generation; the snapshot we loaded from, and the journal we are appending to
+journal_generation = 0
+journal_record_count = 0
+is_compacting = False
+snapshot_lock = threading.Lock()
+
+word_text_file = "LiveRAG_WordText.bin"
+word_offsets_file = "LiveRAG_WordOffsets.npy"
+word_counts_file = "LiveRAG_WordCounts.npy"
+word_values_file = "LiveRAG_WordValues.npy"
+
+me_ids_file = "LiveRAG_MeIDs.npy"
+me_offsets_file = "LiveRAG_MeOffsets.npy"
+her_ids_file = "LiveRAG_HerIDs.npy"
+her_offsets_file = "LiveRAG_HerOffsets.npy"
+scores_file = "LiveRAG_Scores.npy"
+
+# History text has 3 fields per pair; my message, her message, and any extras (tags, timestamp) as JSON
+history_text_file = "LiveRAG_HistoryText.bin"
+history_offsets_file = "LiveRAG_HistoryOffsets.npy"
+
+# For finding a word without decoding them all; the CRC32 of each word, sorted, and the word IDs in that same order
+word_hashes_file = "LiveRAG_WordHashes.npy"
+word_hash_ids_file = "LiveRAG_WordHashIDs.npy"
+
+# Inverted word index; for each word ID, the message pairs with it in my message and in hers (as offsets into the pair
+# IDs), plus the pairs with no words left in either. Worked out from the history word IDs as the snapshot gets written
+me_posting_offsets_file = "LiveRAG_MePostingOffsets.npy"
+me_posting_ids_file = "LiveRAG_MePostingIDs.npy"
+her_posting_offsets_file = "LiveRAG_HerPostingOffsets.npy"
+her_posting_ids_file = "LiveRAG_HerPostingIDs.npy"
+empty_pair_ids_file = "LiveRAG_EmptyPairIDs.npy"
+
+# The inverted word index of the snapshot we loaded, or None if it didn't have one (saved before there was one)
+saved_postings = None
+
+# The cold tier, the memory-mapped files of the current snapshot. History text not in memory (all of it that was loaded,
+# and anything evicted in memory budget mode) and evicted words get read back from here. Swapped over as each new one is saved
+use_cold_tier = False
+cold_tier = None
+
+# The old JSON database, only read for migrating
+json_words_file = "LiveRAG_Words.json"
+json_history_word_id_file = "LiveRAG_HistoryWordID.json"
+json_history_file = "LiveRAG_History.json"
+
+
+# Checks if there is a binary database saved
+def binary_database_exists():
+    return os.path.isfile(rag_folder + meta_file)
+
+
+# Checks if there is an old JSON database saved
+def json_database_exists():
+    return (os.path.isfile(rag_folder + json_words_file) and os.path.isfile(rag_folder + json_history_word_id_file)
+            and os.path.isfile(rag_folder + json_history_file))
+
+
+# Saves the whole database as a new snapshot, starting a fresh journal (blocks until done)
+def save_database(word_database, histories_word_id_database, history_database):
+    global journal_generation, journal_record_count
+
+    journal_generation += 1
+    journal_record_count = 0
+
+    write_snapshot(word_database, histories_word_id_database, history_database, journal_generation)
+
+
+# Writes a snapshot for the given generation, then points the meta file at it and clears out anything older
+def write_snapshot(word_database, histories_word_id_database, history_database, generation):
+
+    folder = rag_folder + snapshot_folder_prefix + str(generation) + "/"
+
+    # Start clean, in case a previous attempt at this generation was cut off
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    # Words (any left in the cold tier get copied over from it)
+    word_count = len(word_database['word'])
+    word_hashes = np.zeros(word_count, dtype=np.uint32)
+
+    word_offsets = write_texts(folder, word_text_file, encode_words(word_database['word']), word_count, word_hashes)
+    write_array(folder, word_offsets_file, word_offsets)
+
+    word_hash_ids = np.argsort(word_hashes, kind='stable')
+    write_array(folder, word_hashes_file, word_hashes[word_hash_ids])
+    write_array(folder, word_hash_ids_file, word_hash_ids)
+    write_array(folder, word_counts_file, np.asarray(word_database['count'], dtype=np.int64))
+    write_array(folder, word_values_file, np.asarray(word_database['value'], dtype=np.float64))
+
+    # History word IDs
+    me_offsets, me_ids = pack_id_lists(histories_word_id_database['me'])
+    write_array(folder, me_ids_file, me_ids)
+    write_array(folder, me_offsets_file, me_offsets)
+
+    her_offsets, her_ids = pack_id_lists(histories_word_id_database['her'])
+    write_array(folder, her_ids_file, her_ids)
+    write_array(folder, her_offsets_file, her_offsets)
+
+    write_array(folder, scores_file, np.asarray(histories_word_id_database['scores'], dtype=np.float64))
+
+    # Inverted word index, from the same word IDs
+    me_posting_offsets, me_posting_ids = pack_postings(me_offsets, me_ids, word_count)
+    write_array(folder, me_posting_offsets_file, me_posting_offsets)
+    write_array(folder, me_posting_ids_file, me_posting_ids)
+
+    her_posting_offsets, her_posting_ids = pack_postings(her_offsets, her_ids, word_count)
+    write_array(folder, her_posting_offsets_file, her_posting_offsets)
+    write_array(folder, her_posting_ids_file, her_posting_ids)
+
+    write_array(folder, empty_pair_ids_file, np.flatnonzero((np.diff(me_offsets) == 0) & (np.diff(her_offsets) == 0)))
+
+    # History text (written as it goes, so it never all has to be in memory at once)
+    history_offsets = write_texts(folder, history_text_file, encode_history_fields(history_database), len(history_database) * 3)
+    write_array(folder, history_offsets_file, history_offsets)
+
+    # Meta goes last, as swapping it over is what makes the new snapshot the live one
+    with snapshot_lock:
+
+        # Never go back to an older snapshot, if a newer one got saved while we were writing (background compaction)
+        if binary_database_exists():
+            with open(rag_folder + meta_file, 'r') as openfile:
+                if json.load(openfile).get('generation', 0) > generation:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    return
+
+        write_meta(word_database, history_database, generation)
+
+        # Read cold entries from the new snapshot from here on, before the old one gets removed
+        if use_cold_tier:
+            open_cold_tier(folder)
+
+        remove_old_generations(generation)
+
+
+def write_meta(word_database, history_database, generation):
+
+    meta = {
+        'format': binary_format_version,
+        'generation': generation,
+        'total_word_count': word_database['total_word_count'],
+        'stop_word_ratio': word_database.get('stop_word_ratio', 0.000937),
+        'pair_count': len(history_database)
+    }
+
+    with open(rag_folder + meta_file + ".tmp", 'w') as outfile:
+        json.dump(meta, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(rag_folder + meta_file + ".tmp", rag_folder + meta_file)
+
+
+# Loads the whole database (snapshot, then any journal on top), returning the word database, history word ID database,
+# and history database. History text is only decoded for the given number of newest pairs, the rest is left as None and
+# read from the cold tier when needed. Only decodes the words used more than once too, if asked, same deal. The saved
+# inverted word index (if there is one) is kept as it is, for the search to read from
+def load_database(hot_history_pairs=0, hot_words_only=False):
+    global journal_generation, journal_record_count, saved_postings
+
+    with open(rag_folder + meta_file, 'r') as openfile:
+        meta = json.load(openfile)
+
+    folder = rag_folder + snapshot_folder_prefix + str(meta['generation']) + "/"
+
+    # Words
+    word_text = read_bytes(folder, word_text_file)
+    word_offsets = read_array(folder, word_offsets_file)
+    word_counts = read_array(folder, word_counts_file)
+
+    if not hot_words_only:
+        words = unpack_texts(word_offsets, word_text)
+    else:
+        hot_words = word_counts > 1
+        hot_words[:1] = True
+        words = unpack_texts_where(word_offsets, word_text, hot_words)
+
+    word_database = {
+        'word': words,
+        'count': word_counts.tolist(),
+        'value': read_array(folder, word_values_file).tolist(),
+        'total_word_count': meta['total_word_count'],
+        'stop_word_ratio': meta.get('stop_word_ratio', 0.000937)
+    }
+
+    # History word IDs
+    histories_word_id_database = {
+        'me': unpack_id_lists(read_array(folder, me_offsets_file), read_array(folder, me_ids_file)),
+        'her': unpack_id_lists(read_array(folder, her_offsets_file), read_array(folder, her_ids_file)),
+        'scores': read_array(folder, scores_file).tolist()
+    }
+
+    # History text, just the hot tail
+    history_offsets = read_array(folder, history_offsets_file)
+    pair_count = (len(history_offsets) - 1) // 3
+
+    hot_start = max(0, pair_count - hot_history_pairs)
+
+    history_fields = unpack_texts(history_offsets[hot_start * 3:], read_bytes(folder, history_text_file))
+
+    history_database = [None] * hot_start
+    i = 0
+    while i < len(history_fields):
+        history_database.append(unpack_history_extras(history_fields[i], history_fields[i + 1], history_fields[i + 2]))
+        i = i + 3
+
+    # Inverted word index, read right in (not memory-mapped, so the snapshot can still be cleared out once it's old)
+    saved_postings = None
+    if os.path.isfile(folder + empty_pair_ids_file):
+        saved_postings = {
+            'me_offsets': np.load(folder + me_posting_offsets_file),
+            'me_ids': np.load(folder + me_posting_ids_file),
+            'her_offsets': np.load(folder + her_posting_offsets_file),
+            'her_ids': np.load(folder + her_posting_ids_file),
+            'empty': np.load(folder + empty_pair_ids_file),
+            'pair_count': len(histories_word_id_database['me'])
+        }
+
+    # Replay the journals, oldest first. There can be two if we got cut off in the middle of a compaction
+    journal_generation = meta['generation']
+    journal_record_count = 0
+
+    for generation in list_journal_generations():
+        if generation < meta['generation']:
+            continue
+
+        for record in read_journal(generation):
+            apply_journal_record(record, word_database, histories_word_id_database, history_database)
+            journal_record_count += 1
+
+        journal_generation = generation
+
+    if use_cold_tier:
+        open_cold_tier(folder)
+
+    # Clear out anything older that couldn't be removed last session
+    remove_old_generations(meta['generation'])
+
+    return word_database, histories_word_id_database, history_database
+
+
+# Opens up a snapshot as the cold tier. Snapshots from before the word hashes were saved get them worked out here
+def open_cold_tier(folder):
+    global cold_tier
+
+    new_cold_tier = {
+        'word_text': read_bytes(folder, word_text_file),
+        'word_offsets': read_array(folder, word_offsets_file),
+        'history_text': read_bytes(folder, history_text_file),
+        'history_offsets': read_array(folder, history_offsets_file)
+    }
+
+    new_cold_tier['word_count'] = len(new_cold_tier['word_offsets']) - 1
+    new_cold_tier['pair_count'] = (len(new_cold_tier['history_offsets']) - 1) // 3
+
+    if os.path.isfile(folder + word_hashes_file) and os.path.isfile(folder + word_hash_ids_file):
+        new_cold_tier['word_hashes'] = read_array(folder, word_hashes_file)
+        new_cold_tier['word_hash_ids'] = read_array(folder, word_hash_ids_file)
+    else:
+        word_offsets = new_cold_tier['word_offsets'].tolist()
+        word_text = memoryview(new_cold_tier['word_text'])
+        word_hashes = np.fromiter((zlib.crc32(word_text[word_offsets[i]:word_offsets[i + 1]]) for i in range(len(word_offsets) - 1)),
+                                  dtype=np.uint32, count=len(word_offsets) - 1)
+
+        word_hash_ids = np.argsort(word_hashes, kind='stable')
+        new_cold_tier['word_hashes'] = word_hashes[word_hash_ids]
+        new_cold_tier['word_hash_ids'] = word_hash_ids
+
+    cold_tier = new_cold_tier
+
+
+# Reads a word out of the cold tier
+def read_cold_word(word_id):
+    return read_text(cold_tier['word_offsets'], cold_tier['word_text'], word_id)
+
+
+# Reads a message pair out of the cold tier
+def read_cold_history(pair_id):
+
+    history_offsets = cold_tier['history_offsets']
+    history_text = cold_tier['history_text']
+
+    return unpack_history_extras(read_text(history_offsets, history_text, pair_id * 3),
+                                 read_text(history_offsets, history_text, pair_id * 3 + 1),
+                                 read_text(history_offsets, history_text, pair_id * 3 + 2))
+
+
+# Finds the ID of a word in the cold tier (the first one, if it is ever doubled up), or None if it is not in there
+def find_cold_word(word):
+
+    if cold_tier is None:
+        return None
+
+    word_hash = np.uint32(zlib.crc32(word.encode('utf-8')))
+    first = int(np.searchsorted(cold_tier['word_hashes'], word_hash, side='left'))
+    last = int(np.searchsorted(cold_tier['word_hashes'], word_hash, side='right'))
+
+    for word_id in cold_tier['word_hash_ids'][first:last].tolist():
+        if read_cold_word(word_id) == word:
+            return word_id
+
+    return None
+
+
+# Applies one journal record to the database
+def apply_journal_record(record, word_database, histories_word_id_database, history_database):
+
+    # New words and word count changes
+    if record['op'] == "words":
+        for word in record['new']:
+            word_database['word'].append(word)
+            word_database['count'].append(0)
+            word_database['value'].append(0.99)
+
+        for word_id, count_delta in record['counts']:
+            word_database['count'][word_id] += count_delta
+
+        word_database['total_word_count'] += record['total']
+
+    # Added message pair
+    elif record['op'] == "add":
+        histories_word_id_database['me'].append(record['me'])
+        histories_word_id_database['her'].append(record['her'])
+        histories_word_id_database['scores'].append(0)
+        history_database.append(record['history'])
+
+    # New tags for a message pair (like it getting pinned)
+    elif record['op'] == "tags":
+        history_database[record['pair']] = record['history']
+
+    # Undo of the latest message pair (matches remove_latest_database_message, which leaves the history text)
+    elif record['op'] == "undo":
+        histories_word_id_database['me'].pop()
+        histories_word_id_database['her'].pop()
+        histories_word_id_database['scores'].pop()
+
+
+# Appends records to the current journal. Each one is a single line, flushed to disk right away
+def append_journal(records):
+    global journal_record_count
+
+    if len(records) == 0:
+        return
+
+    with open(rag_folder + journal_file_prefix + str(journal_generation) + ".jsonl", 'a', encoding='utf-8') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record) + "\n")
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    journal_record_count += len(records)
+
+
+# Reads all the records of a journal. A half-written last line (crash mid-write) is dropped and cut off the file
+def read_journal(generation):
+
+    path = rag_folder + journal_file_prefix + str(generation) + ".jsonl"
+
+    records = []
+    good_length = 0
+
+    with open(path, 'rb') as openfile:
+        for line in openfile:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+
+            good_length += len(line)
+
+    if good_length < os.path.getsize(path):
+        with open(path, 'r+b') as outfile:
+            outfile.truncate(good_length)
+
+    return records
+
+
+# Lists the generations of all journals on disk, oldest first
+def list_journal_generations():
+
+    generations = []
+    for file in os.listdir(rag_folder):
+        match = re.fullmatch(re.escape(journal_file_prefix) + r"(\d+)\.jsonl", file)
+        if match:
+            generations.append(int(match.group(1)))
+
+    return sorted(generations)
+
+
+# Checks if the journal is big enough to fold into a snapshot
+def journal_needs_compacting():
+    return journal_record_count >= journal_compact_limit and not is_compacting
+
+
+# Folds the journal into a new snapshot, in the background. Takes copies of the lists, so we can keep adding meanwhile
+def start_compaction(word_database, histories_word_id_database, history_database):
+    global journal_generation, journal_record_count, is_compacting
+
+    word_database_copy = {
+        'word': list(word_database['word']),
+        'count': list(word_database['count']),
+        'value': list(word_database['value']),
+        'total_word_count': word_database['total_word_count'],
+        'stop_word_ratio': word_database.get('stop_word_ratio', 0.000937)
+    }
+
+    histories_word_id_database_copy = {
+        'me': list(histories_word_id_database['me']),
+        'her': list(histories_word_id_database['her']),
+        'scores': list(histories_word_id_database['scores'])
+    }
+
+    history_database_copy = list(history_database)
+
+    # New records go in the next journal from here on, and the snapshot takes over everything before it
+    journal_generation += 1
+    journal_record_count = 0
+    is_compacting = True
+
+    compaction_thread = threading.Thread(target=run_compaction, args=(word_database_copy, histories_word_id_database_copy, history_database_copy, journal_generation))
+    compaction_thread.daemon = True
+    compaction_thread.start()
+
+
+def run_compaction(word_database, histories_word_id_database, history_database, generation):
+    global is_compacting
+
+    try:
+        write_snapshot(word_database, histories_word_id_database, history_database, generation)
+    finally:
+        is_compacting = False
+
+
+# Removes snapshots and journals from before the given generation. Anything that can't be removed yet (on Windows, a
+# search may still have the old snapshot mapped) gets logged and left, and is tried again on the next compaction or load
+def remove_old_generations(generation):
+
+    for file in os.listdir(rag_folder):
+        snapshot_match = re.fullmatch(re.escape(snapshot_folder_prefix) + r"(\d+)", file)
+        journal_match = re.fullmatch(re.escape(journal_file_prefix) + r"(\d+)\.jsonl", file)
+
+        try:
+            if snapshot_match and int(snapshot_match.group(1)) < generation:
+                shutil.rmtree(rag_folder + file)
+
+            if journal_match and int(journal_match.group(1)) < generation:
+                os.remove(rag_folder + file)
+
+        except OSError as e:
+            utils.zw_logging.update_debug_log("Could not clear out old RAG save " + file + ", will try again later! " + str(e))
+
+
+# Loads the old JSON database, moving the files to the backups once read (one-time migration, they get saved as binary next)
+def load_and_retire_json_database():
+
+    with open(rag_folder + json_words_file, 'r') as openfile:
+        word_database = json.load(openfile)
+
+    with open(rag_folder + json_history_word_id_file, 'r') as openfile:
+        histories_word_id_database = json.load(openfile)
+
+    with open(rag_folder + json_history_file, 'r') as openfile:
+        history_database = json.load(openfile)
+
+    # Save as binary right away, then move the old ones out of the way
+    save_database(word_database, histories_word_id_database, history_database)
+
+    for file in [json_words_file, json_history_word_id_file, json_history_file]:
+        os.replace(rag_folder + file, "Backups/" + file + ".bak")
+
+    return word_database, histories_word_id_database, history_database
+
+
+# Writes encoded strings out one after the other as one UTF-8 blob, returning the offsets marking where each one starts
+# and ends. Can fill in the CRC32 of each one as well
+def write_texts(folder, file, encoded_texts, count, text_hashes=None):
+
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    text_lengths = []
+
+    with open(folder + file, 'wb') as outfile:
+        for encoded_text in encoded_texts:
+            outfile.write(encoded_text)
+
+            if text_hashes is not None:
+                text_hashes[len(text_lengths)] = zlib.crc32(encoded_text)
+            text_lengths.append(len(encoded_text))
+
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    np.cumsum(np.asarray(text_lengths, dtype=np.int64), out=offsets[1:])
+
+    return offsets
+
+
+# Encodes each word, reading any that are not in memory out of the cold tier (as raw bytes, no need to decode them)
+def encode_words(words):
+
+    word_id = 0
+    while word_id < len(words):
+        if words[word_id] is None:
+            yield read_raw_text(cold_tier['word_offsets'], cold_tier['word_text'], word_id)
+        else:
+            yield words[word_id].encode('utf-8')
+
+        word_id = word_id + 1
+
+
+# Encodes the 3 fields of each message pair, copying any that are not in memory straight over from the cold tier
+def encode_history_fields(history_database):
+
+    pair_id = 0
+    while pair_id < len(history_database):
+        history = history_database[pair_id]
+
+        if history is None:
+            yield read_raw_text(cold_tier['history_offsets'], cold_tier['history_text'], pair_id * 3)
+            yield read_raw_text(cold_tier['history_offsets'], cold_tier['history_text'], pair_id * 3 + 1)
+            yield read_raw_text(cold_tier['history_offsets'], cold_tier['history_text'], pair_id * 3 + 2)
+        else:
+            yield history[0].encode('utf-8')
+            yield history[1].encode('utf-8')
+            yield pack_history_extras(history).encode('utf-8')
+
+        pair_id = pair_id + 1
+
+
+# Decodes a list of strings back out of a UTF-8 blob
+def unpack_texts(offsets, blob):
+
+    offsets = offsets.tolist()
+    blob = memoryview(blob)
+
+    return [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+
+
+# Decodes only the strings picked out by the mask, leaving the rest as None
+def unpack_texts_where(offsets, blob, keep):
+
+    offsets = offsets.tolist()
+    blob = memoryview(blob)
+
+    texts = [None] * (len(offsets) - 1)
+    for i in np.flatnonzero(keep).tolist():
+        texts[i] = str(blob[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    return texts
+
+
+# Reads one string straight out of a blob, by its offsets
+def read_text(offsets, blob, i):
+    return str(read_raw_text(offsets, blob, i), 'utf-8')
+
+
+def read_raw_text(offsets, blob, i):
+    return bytes(blob[int(offsets[i]):int(offsets[i + 1])])
+
+
+# Flattens a list of ID lists into one array, with offsets marking where each list starts and ends
+def pack_id_lists(id_lists):
+
+    offsets = np.zeros(len(id_lists) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(ids) for ids in id_lists), dtype=np.int64, count=len(id_lists)), out=offsets[1:])
+
+    flat_ids = np.fromiter((word_id for ids in id_lists for word_id in ids), dtype=np.int64, count=int(offsets[-1]))
+
+    return offsets, flat_ids
+
+
+# Splits a flat ID array back into a list of ID lists
+def unpack_id_lists(offsets, flat_ids):
+
+    offsets = offsets.tolist()
+    flat_ids = flat_ids.tolist()
+
+    return [flat_ids[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+# Turns the flattened ID lists of each message pair around, into the message pairs each word ID is in (each pair once,
+# in order), with offsets marking where each word's pairs start and end
+def pack_postings(offsets, flat_ids, word_count):
+
+    pair_ids = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+
+    order = np.lexsort((pair_ids, flat_ids))
+    word_ids = flat_ids[order]
+    pair_ids = pair_ids[order]
+
+    # A word more than once in a message still only lists the pair once
+    first = np.ones(len(word_ids), dtype=bool)
+    first[1:] = (word_ids[1:] != word_ids[:-1]) | (pair_ids[1:] != pair_ids[:-1])
+    word_ids = word_ids[first]
+    pair_ids = pair_ids[first]
+
+    word_pair_counts = np.bincount(word_ids, minlength=word_count)
+    posting_offsets = np.zeros(len(word_pair_counts) + 1, dtype=np.int64)
+    np.cumsum(word_pair_counts, out=posting_offsets[1:])
+
+    return posting_offsets, pair_ids
+
+
+# Reads the message pairs a word is in out of the saved inverted index, for one side ('me' or 'her')
+def read_saved_pair_ids(postings, side, word_id):
+
+    posting_offsets = postings[side + '_offsets']
+
+    if word_id + 1 >= len(posting_offsets):
+        return []
+
+    return postings[side + '_ids'][posting_offsets[word_id]:posting_offsets[word_id + 1]].tolist()
+
+
+# Anything past the two messages (tags, timestamp) gets stored as JSON, or blank if there is none
+def pack_history_extras(history):
+    if len(history) <= 2:
+        return ""
+
+    return json.dumps(history[2:])
+
+
+def unpack_history_extras(message_a, message_b, extras):
+    if extras == "":
+        return [message_a, message_b]
+
+    return [message_a, message_b] + json.loads(extras)
+
+
+def write_array(folder, file, array):
+    with open(folder + file, 'wb') as outfile:
+        np.save(outfile, array)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+# Arrays are memory-mapped, so they are only paged in as they are read
+def read_array(folder, file):
+    return np.load(folder + file, mmap_mode='r')
+
+
+def read_bytes(folder, file):
+
+    # Memory-mapping an empty file is not allowed, so skip it
+    if os.path.getsize(folder + file) == 0:
+        return b""
+
+    return np.memmap(folder + file, dtype=np.uint8, mode='r')
@@ -0,0 +1,136 @@
+import math
+
+#
+# BM25 scoring for the BASED RAG. Rather than the flat keyword hit count and length penalty, each message pair (both
+# messages together) is ranked with BM25, which weighs rarer words higher and evens out long and short pairs.
+# The postings and lengths are kept up to date as pairs get added or undone, touching only the words in that pair. The
+# IDF of a keyword is worked out when it gets searched, from how many pairs it is in, so no word ever goes stale.
+#
+
+# Tuning; how quickly repeats of a word stop adding score, and how much the pair length matters
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+# Which pairs each word is in, and how many times, as [pair ID, term frequency] (not saved, rebuilt on load). How many
+# pairs a word is in (its document frequency) is just how long its list is
+term_postings = {}
+
+# Per pair; how many words it has, plus the total so the average length is always ready
+pair_lengths = []
+total_pair_length = 0
+average_pair_length = 0.0
+
+
+# Builds all of the stats from scratch, from the history word ID lists
+def build_stats(histories_word_id_database):
+    global term_postings, pair_lengths, total_pair_length
+
+    term_postings = {}
+    pair_lengths = []
+    total_pair_length = 0
+
+    i = 0
+    while i < len(histories_word_id_database['me']):
+        index_pair(histories_word_id_database['me'][i], histories_word_id_database['her'][i])
+        i = i + 1
+
+    refresh_average_length()
+
+
+# Adds a message pair (must be the newest one)
+def add_pair(me_word_ids, her_word_ids):
+
+    index_pair(me_word_ids, her_word_ids)
+    refresh_average_length()
+
+
+# Removes the newest message pair (undo), needs the word IDs it was added with
+def pop_pair(me_word_ids, her_word_ids):
+    global total_pair_length, pair_lengths
+
+    if len(pair_lengths) == 0:
+        return
+
+    pair_id = len(pair_lengths) - 1
+
+    for word_id in set(me_word_ids + her_word_ids):
+        postings = term_postings.get(word_id)
+        if postings and postings[-1][0] == pair_id:
+            postings.pop()
+            if len(postings) == 0:
+                del term_postings[word_id]
+
+    # Swapped for a shorter copy, rather than popped, in case a search is still going over the lengths
+    total_pair_length -= pair_lengths[-1]
+    pair_lengths = pair_lengths[:-1]
+
+    refresh_average_length()
+
+
+# Counts a message pair into the postings and lengths
+def index_pair(me_word_ids, her_word_ids):
+    global total_pair_length
+
+    pair_id = len(pair_lengths)
+    pair_word_ids = me_word_ids + her_word_ids
+
+    term_frequencies = {}
+    for word_id in pair_word_ids:
+        term_frequencies[word_id] = term_frequencies.get(word_id, 0) + 1
+
+    for word_id in term_frequencies:
+        term_postings.setdefault(word_id, []).append([pair_id, term_frequencies[word_id]])
+
+    pair_lengths.append(len(pair_word_ids))
+    total_pair_length += len(pair_word_ids)
+
+
+# Recomputes the average pair length, from the running total
+def refresh_average_length():
+    global average_pair_length
+
+    pair_count = len(pair_lengths)
+    if pair_count > 0:
+        average_pair_length = total_pair_length / pair_count
+    else:
+        average_pair_length = 0.0
+
+
+# Scores all message pairs that contain any of the given keywords. Repeated keywords and word 0 (empty slots) are skipped.
+# Only scores up to the given number of pairs, if a search wants to stick to what was there when it started
+def score_pairs(valued_word_ids, pair_count=None):
+
+    # Grab these once, as a pair may get added or undone while we search
+    lengths = pair_lengths
+    average_length = average_pair_length
+
+    if pair_count is None or pair_count > len(lengths):
+        pair_count = len(lengths)
+
+    pair_scores = {}
+
+    for word_id in set(valued_word_ids):
+        postings = term_postings.get(word_id)
+        if word_id == 0 or not postings:
+            continue
+
+        # How many of the pairs we are searching it is in (any newer than that are on the end)
+        document_frequency = len(postings)
+        while document_frequency > 0 and postings[document_frequency - 1][0] >= pair_count:
+            document_frequency -= 1
+
+        if document_frequency == 0:
+            continue
+
+        idf = math.log(1 + (pair_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+        for pair_id, term_frequency in postings:
+            if pair_id >= pair_count:
+                continue
+
+            length_ratio = lengths[pair_id] / average_length
+            score = idf * (term_frequency * (bm25_k1 + 1)) / (term_frequency + bm25_k1 * (1 - bm25_b + bm25_b * length_ratio))
+
+            pair_scores[pair_id] = pair_scores.get(pair_id, 0.0) + float(score)
+
+    return pair_scores
@@ -0,0 +1,379 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+import utils.rag_recency
+
+#
+# Embedding engine for the BASED RAG. Instead of matching keywords, every message pair gets turned into a vector that
+# captures its meaning, and we recall the pair closest to what is being said. Runs fully offline, on the CPU.
+#
+# If a small ONNX sentence embedding model (like all-MiniLM-L6-v2) is put in Models/Embedding/, as model.onnx and
+# tokenizer.json, we use that. Otherwise we fall back to hashed word and letter n-grams, which need nothing at all.
+#
+# Vectors are kept in a float16 matrix, and once there are enough of them, searched with an IVF index (clusters of
+# vectors, where we only check the clusters closest to our query).
+#
+
+embedding_model_folder = "Models/Embedding/"
+embedding_file = "RAG_Database/LiveRAG_Embeddings.npy"
+embedding_meta_file = "RAG_Database/LiveRAG_EmbeddingsMeta.json"
+
+# Which embedder we are using, and how many dimensions it gives
+embedder_name = "None"
+embedding_dims = 384
+onnx_session = None
+onnx_tokenizer = None
+
+# How many texts to embed at once, and the most tokens of each one the model gets to see
+embedding_batch_size = 32
+embedding_max_tokens = 256
+
+# How many message pairs to get the text of at once, when embedding a lot of them (a whole number of batches)
+embedding_chunk_size = embedding_batch_size * 64
+
+# Hashed n-gram fallback, how many dimensions it uses
+hashed_embedding_dims = 512
+
+# All of the vectors, one row per message pair (grows by doubling, only the first embedding_rows are real)
+embedding_matrix = np.zeros((0, embedding_dims), dtype=np.float16)
+embedding_rows = 0
+embeddings_changed = False
+
+# How much her last message counts towards what we search for
+her_query_weight = 0.5
+
+# IVF index. Only used once there are enough vectors, below that we just check them all
+ivf_min_rows = 2048
+ivf_probe_count = 8
+ivf_centroids = None
+ivf_lists = []
+ivf_row_lists = []          # Which list each row is in, so undo can take it back out
+ivf_trained_rows = 0
+
+
+# Loads up the embedding model, if there is one and we have what is needed to run it, or picks the hashed n-grams
+def load_embedder():
+    global embedder_name, embedding_dims, onnx_session, onnx_tokenizer
+
+    model_file = embedding_model_folder + "model.onnx"
+    tokenizer_file = embedding_model_folder + "tokenizer.json"
+
+    if os.path.exists(model_file) and os.path.exists(tokenizer_file):
+        try:
+            import onnxruntime
+            import tokenizers
+
+            onnx_tokenizer = tokenizers.Tokenizer.from_file(tokenizer_file)
+            onnx_tokenizer.enable_truncation(max_length=embedding_max_tokens)
+            onnx_tokenizer.enable_padding()
+
+            onnx_session = onnxruntime.InferenceSession(model_file, providers=["CPUExecutionProvider"])
+
+            # Run a quick test, to see how many dimensions it gives us
+            embedder_name = "ONNX:" + str(os.path.getsize(model_file))
+            embedding_dims = int(run_onnx_model(["test"]).shape[1])
+            return
+
+        except Exception as e:
+            print("\nCould not load the RAG embedding model, using hashed n-grams instead! " + str(e) + "\n")
+            onnx_session = None
+            onnx_tokenizer = None
+
+    embedder_name = "Hashed:" + str(hashed_embedding_dims)
+    embedding_dims = hashed_embedding_dims
+
+
+# Runs a batch of texts through the ONNX model, mean pooling the tokens into one vector each
+def run_onnx_model(texts):
+
+    encodings = onnx_tokenizer.encode_batch(texts)
+    input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+    attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+
+    model_inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+    input_names = [model_input.name for model_input in onnx_session.get_inputs()]
+    if "token_type_ids" in input_names:
+        model_inputs['token_type_ids'] = np.zeros_like(input_ids)
+
+    token_vectors = onnx_session.run(None, model_inputs)[0]
+
+    mask = attention_mask[:, :, None].astype(np.float32)
+    return (token_vectors * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+
+
+# Makes a vector out of hashed words and letter trigrams. Same text always gives the same vector, on any computer
+def hash_embed_text(text):
+
+    vector = np.zeros(hashed_embedding_dims, dtype=np.float32)
+    words = re.findall(r"\w+", text.lower())
+
+    features = list(words)
+    for word in words:
+        padded_word = "<" + word + ">"
+        features += [padded_word[i:i + 3] for i in range(len(padded_word) - 2)]
+
+    for feature in features:
+        feature_hash = zlib.crc32(feature.encode('utf-8'))
+        sign = 1.0 if (feature_hash >> 31) & 1 else -1.0
+        vector[feature_hash % hashed_embedding_dims] += sign
+
+    # Dampen repeats, so a word said ten times doesn't drown everything else out
+    return np.sign(vector) * np.log1p(np.abs(vector))
+
+
+# Embeds a list of texts, in batches, as unit length float16 vectors
+def embed_texts(texts, progress_bar=None):
+
+    vectors = np.zeros((len(texts), embedding_dims), dtype=np.float32)
+
+    i = 0
+    while i < len(texts):
+        batch = texts[i:i + embedding_batch_size]
+
+        if onnx_session is not None:
+            vectors[i:i + len(batch)] = run_onnx_model(batch)
+        else:
+            vectors[i:i + len(batch)] = [hash_embed_text(text) for text in batch]
+
+        if progress_bar is not None:
+            progress_bar.update(len(batch))
+
+        i = i + embedding_batch_size
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.maximum(norms, 1e-12)
+
+    return vectors.astype(np.float16)
+
+
+# The text we embed for a message pair
+def pair_text(history):
+    return history[0] + "\n" + history[1]
+
+
+# Embeds a range of message pairs, getting their text a chunk at a time (the history may not all be in memory)
+def embed_pairs(get_history_pair, start_id, end_id, progress_bar=None):
+
+    vectors = np.zeros((end_id - start_id, embedding_dims), dtype=np.float16)
+
+    i = start_id
+    while i < end_id:
+        chunk_end = min(i + embedding_chunk_size, end_id)
+        vectors[i - start_id:chunk_end - start_id] = embed_texts([pair_text(get_history_pair(j)) for j in range(i, chunk_end)], progress_bar)
+        i = chunk_end
+
+    return vectors
+
+
+# Embeds every message pair from scratch (in batches), and indexes them
+def build_index(pair_count, get_history_pair, progress_bar=None):
+    global embedding_matrix, embedding_rows, embeddings_changed
+
+    if embedder_name == "None":
+        load_embedder()
+
+    embedding_matrix = embed_pairs(get_history_pair, 0, pair_count, progress_bar)
+    embedding_rows = pair_count
+    embeddings_changed = True
+
+    train_ivf_index()
+
+
+# Loads the saved vectors, only embedding any pairs that are missing from them. Re-embeds it all if the embedder changed
+def load_index(pair_count, get_history_pair, progress_bar=None):
+    global embedding_matrix, embedding_rows, embeddings_changed
+
+    if embedder_name == "None":
+        load_embedder()
+
+    if not os.path.exists(embedding_file) or not os.path.exists(embedding_meta_file):
+        build_index(pair_count, get_history_pair, progress_bar)
+        return
+
+    with open(embedding_meta_file, 'r') as openfile:
+        embedding_meta = json.load(openfile)
+
+    if embedding_meta.get('embedder') != embedder_name:
+        build_index(pair_count, get_history_pair, progress_bar)
+        return
+
+    saved_matrix = np.load(embedding_file)
+    saved_rows = min(len(saved_matrix), pair_count)
+
+    embedding_matrix = np.zeros((pair_count, embedding_dims), dtype=np.float16)
+    embedding_matrix[:saved_rows] = saved_matrix[:saved_rows]
+    embedding_matrix[saved_rows:] = embed_pairs(get_history_pair, saved_rows, pair_count, progress_bar)
+    embedding_rows = pair_count
+    embeddings_changed = saved_rows != len(saved_matrix) or saved_rows != pair_count
+
+    train_ivf_index()
+
+
+# Saves the vectors, if there is anything new. Written to a temp file first, so a crash never leaves half a file
+def save_index():
+    global embeddings_changed
+
+    if not embeddings_changed:
+        return
+
+    with open(embedding_file + ".tmp", 'wb') as outfile:
+        np.save(outfile, embedding_matrix[:embedding_rows])
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(embedding_file + ".tmp", embedding_file)
+
+    with open(embedding_meta_file, 'w') as outfile:
+        json.dump({'embedder': embedder_name, 'dims': embedding_dims, 'rows': embedding_rows}, outfile)
+
+    embeddings_changed = False
+
+
+# Adds in a new message pair (must be the newest one)
+def add_pair(history):
+    global embedding_matrix, embedding_rows, embeddings_changed
+
+    if len(embedding_matrix) <= embedding_rows:
+        grown_matrix = np.zeros((max(embedding_rows + 1, len(embedding_matrix) * 2), embedding_dims), dtype=np.float16)
+        grown_matrix[:embedding_rows] = embedding_matrix[:embedding_rows]
+        embedding_matrix = grown_matrix
+
+    embedding_matrix[embedding_rows] = embed_texts([pair_text(history)])[0]
+    embedding_rows += 1
+    embeddings_changed = True
+
+    # Retrain the clusters whenever we have doubled in size, otherwise just put it in its closest one
+    if embedding_rows >= ivf_min_rows and embedding_rows >= ivf_trained_rows * 2:
+        train_ivf_index()
+    elif ivf_centroids is not None:
+        add_row_to_ivf(embedding_rows - 1)
+
+
+# Removes the newest message pair (undo)
+def pop_pair():
+    global embedding_rows, embeddings_changed
+
+    if embedding_rows == 0:
+        return
+
+    embedding_rows -= 1
+    embeddings_changed = True
+
+    if ivf_centroids is not None and len(ivf_row_lists) > embedding_rows:
+        ivf_lists[ivf_row_lists.pop()].pop()
+
+
+# Finds the ID of the message pair closest to what we are talking about (or 0 if there is nothing to pick)
+def find_best_pair(message, her_previous, cutoff_id):
+
+    return pick_best_pair(score_candidate_pairs(message, her_previous, cutoff_id))
+
+
+# Picks the best scoring pair (pair ID to similarity), the latest one on a tie. 0 if there are none
+def pick_best_pair(pair_scores):
+
+    if len(pair_scores) == 0:
+        return 0
+
+    best_message_score = max(pair_scores.values())
+    return max(pair_id for pair_id in pair_scores if pair_scores[pair_id] == best_message_score)
+
+
+# Scores the message pairs that are close to what we are talking about, as pair ID to similarity. With the IVF index
+# this is just the pairs in the closest clusters, otherwise it is every pair up to the cutoff
+def score_candidate_pairs(message, her_previous, cutoff_id, include_neighbours=False):
+
+    if cutoff_id <= 1:
+        return {}
+
+    query_vector = embed_query(message, her_previous)
+
+    # Grab these once, the rows first, as a pair may get added while we search (the matrix only ever gets bigger)
+    rows = embedding_rows
+    matrix = embedding_matrix
+    centroids = ivf_centroids
+    lists = ivf_lists
+
+    candidate_ids = None
+    if centroids is not None:
+        closest_lists = np.argsort(-(centroids @ query_vector))[:ivf_probe_count]
+        candidate_ids = np.array(sorted(row_id for list_id in closest_lists if list_id < len(lists) for row_id in lists[list_id]
+                                        if 1 <= row_id < min(cutoff_id, rows)), dtype=np.int64)
+
+        # All the close ones are too recent, so just check them all
+        if len(candidate_ids) == 0:
+            candidate_ids = None
+
+    if candidate_ids is None:
+        candidate_ids = np.arange(1, min(cutoff_id, rows), dtype=np.int64)
+
+    # Also score the pairs right before and after each one, for scoring whole memory windows
+    if include_neighbours and len(candidate_ids) > 0:
+        candidate_ids = np.unique(np.concatenate([candidate_ids - 1, candidate_ids, candidate_ids + 1]))
+        candidate_ids = candidate_ids[candidate_ids < rows]
+
+    pair_scores = matrix[candidate_ids].astype(np.float32) @ query_vector
+
+    # Newer (and pinned) memories get a bonus, if we are weighting by recency
+    return utils.rag_recency.add_bonuses(dict(zip(candidate_ids.tolist(), pair_scores.tolist())))
+
+
+# Embeds what is being said, with her last message counting for less
+def embed_query(message, her_previous):
+
+    query_vectors = embed_texts([message, her_previous]).astype(np.float32)
+    return query_vectors[0] + (query_vectors[1] * her_query_weight)
+
+
+# Clusters all of the vectors with k-means, to make the IVF index (only once there are enough to be worth it)
+def train_ivf_index():
+    global ivf_centroids, ivf_lists, ivf_row_lists, ivf_trained_rows
+
+    if embedding_rows < ivf_min_rows:
+        ivf_centroids = None
+        ivf_lists = []
+        ivf_row_lists = []
+        ivf_trained_rows = 0
+        return
+
+    vectors = embedding_matrix[:embedding_rows].astype(np.float32)
+    list_count = int(np.sqrt(embedding_rows))
+
+    # Train on a sample, it is plenty to find the clusters (seeded, so it comes out the same each time)
+    random_generator = np.random.default_rng(0)
+    sample = vectors[random_generator.choice(embedding_rows, min(embedding_rows, list_count * 64), replace=False)]
+    centroids = sample[random_generator.choice(len(sample), list_count, replace=False)]
+
+    for iteration in range(10):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+
+        for list_id in range(list_count):
+            members = sample[assignments == list_id]
+            if len(members) > 0:
+                centroids[list_id] = members.mean(axis=0)
+
+        centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    ivf_centroids = centroids
+    ivf_lists = [[] for list_id in range(list_count)]
+    ivf_row_lists = []
+    ivf_trained_rows = embedding_rows
+
+    # Assign everything, in chunks to keep memory down
+    i = 0
+    while i < embedding_rows:
+        assignments = np.argmax(vectors[i:i + 4096] @ ivf_centroids.T, axis=1)
+        for row_id in range(i, i + len(assignments)):
+            ivf_lists[assignments[row_id - i]].append(row_id)
+            ivf_row_lists.append(int(assignments[row_id - i]))
+
+        i = i + 4096
+
+
+# Puts a vector in its closest cluster
+def add_row_to_ivf(row_id):
+
+    list_id = int(np.argmax(ivf_centroids @ embedding_matrix[row_id].astype(np.float32)))
+    ivf_lists[list_id].append(row_id)
+    ivf_row_lists.append(list_id)
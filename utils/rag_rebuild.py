@@ -0,0 +1,77 @@
+import multiprocessing
+import utils.tokenizer
+
+#
+# Multiprocess rebuilding for the BASED RAG. Splits the history into shards, and each worker process tokenizes and
+# counts its own shard with its own little word list. These then get merged back in order, so the end result is
+# exactly the same as counting everything on one thread, just using all of our cores.
+#
+# NOTE: Keep this module light on imports! Worker processes import it on their own.
+#
+
+
+# Worker; tokenizes and counts one shard of message pairs. Word IDs are local to the shard, in order of first use
+def count_shard(history_shard):
+
+    local_words = []
+    local_counts = []
+    local_index = {}
+    me_word_ids = []
+    her_word_ids = []
+    total_word_count = 0
+
+    for history in history_shard:
+        for message, side_word_ids in [[history[0], me_word_ids], [history[1], her_word_ids]]:
+
+            word_ids = []
+            for word in utils.tokenizer.split_rag_words(message):
+                local_id = local_index.get(word)
+
+                if local_id is None:
+                    local_id = len(local_words)
+                    local_index[word] = local_id
+                    local_words.append(word)
+                    local_counts.append(0)
+
+                local_counts[local_id] += 1
+                word_ids.append(local_id)
+
+            side_word_ids.append(word_ids)
+            total_word_count += len(word_ids)
+
+    return local_words, local_counts, me_word_ids, her_word_ids, total_word_count
+
+
+# Tokenizes and counts all the message pairs over a pool of processes. Gives back each shard's results, in order
+def count_history_parallel(history_database, worker_count, progress_bar=None):
+
+    # Only send over the messages, and split into a few shards per worker so they stay evenly loaded
+    shard_count = worker_count * 4
+    shard_size = max(1, -(-len(history_database) // shard_count))
+
+    history_shards = []
+    i = 0
+    while i < len(history_database):
+        history_shards.append([[history[0], history[1]] for history in history_database[i:i + shard_size]])
+        i = i + shard_size
+
+    shard_results = []
+
+    with start_worker_pool(worker_count) as pool:
+        for shard_result in pool.imap(count_shard, history_shards):
+            shard_results.append(shard_result)
+
+            if progress_bar is not None:
+                progress_bar.update(len(shard_result[2]))
+
+    return shard_results
+
+
+# Starts our pool of worker processes. Always spawned fresh (same as on Windows), rather than forked off of a process
+# with threads running. Spawned workers import main.py again, but its "if __name__" guard stops the program from booting
+# in them; all they run is count_shard from this module
+def start_worker_pool(worker_count):
+
+    # Workers start out with the default tokenizer options, so hand ours over
+    return multiprocessing.get_context("spawn").Pool(worker_count, initializer=utils.tokenizer.set_options,
+                                                     initargs=(utils.tokenizer.use_stemming, utils.tokenizer.use_unicode_punctuation))
@@ -0,0 +1,153 @@
+import math
+import numpy as np
+import utils.rag_sparse
+
+#
+# Recency weighting for the BASED RAG. Message pairs that match the search get a bonus on top of their score, which
+# halves every so often as they get older, plus a flat boost for pinned memories (pairs tagged "Pinned").
+# The bonuses are worked out per pair as they get added, so searching costs nothing extra.
+#
+
+# Settings. A weight and boost of 0 turns it all off
+recency_weight = 0.0            # The bonus a brand new pair gets
+recency_half_life_days = 30.0   # How many days it takes for the bonus to halve
+pinned_boost = 0.0              # Extra bonus for pinned memories, no matter how old
+pinned_tag = "Pinned"
+
+# Per pair; when it was from (in seconds, NaN if it has no timestamp), if it is pinned, and the bonus it gets
+pair_times = np.zeros(0, dtype=np.float64)
+pair_pinned = np.zeros(0, dtype=bool)
+pair_bonuses = np.zeros(0, dtype=np.float64)
+pair_count = 0
+
+
+# Checks if we are weighting by recency at all
+def is_enabled():
+    return recency_weight != 0 or pinned_boost != 0
+
+
+# Works out the times and pins of all pairs from scratch (gets each pair through the given function)
+def build_bonuses(count, get_history_pair):
+    global pair_times, pair_pinned, pair_bonuses, pair_count
+
+    times = np.full(count, np.nan, dtype=np.float64)
+    pinned = np.zeros(count, dtype=bool)
+
+    if is_enabled():
+        i = 0
+        while i < count:
+            history = get_history_pair(i)
+            times[i] = parse_pair_time(history)
+            pinned[i] = is_pair_pinned(history)
+            i = i + 1
+
+    pair_times = times
+    pair_pinned = pinned
+    pair_bonuses = np.zeros(count, dtype=np.float64)
+    pair_count = count
+
+    refresh_bonuses()
+
+
+# Adds a message pair (must be the newest one)
+def add_pair(history):
+    global pair_times, pair_pinned, pair_count
+
+    pair_times = utils.rag_sparse.grow_array(pair_times, pair_count + 1)
+    pair_pinned = utils.rag_sparse.grow_array(pair_pinned, pair_count + 1)
+
+    pair_times[pair_count] = parse_pair_time(history)
+    pair_pinned[pair_count] = is_pair_pinned(history)
+    pair_count += 1
+
+    refresh_bonuses()
+
+
+# Updates if a message pair is pinned, from its history (after its tags changed)
+def set_pair_pinned(pair_id, history):
+    global pair_pinned
+
+    if pair_id >= pair_count:
+        return
+
+    # Changed on a copy then swapped in, so a search never sees it half done
+    new_pair_pinned = pair_pinned.copy()
+    new_pair_pinned[pair_id] = is_pair_pinned(history)
+    pair_pinned = new_pair_pinned
+
+    refresh_bonuses()
+
+
+# Removes the newest message pair (undo)
+def pop_pair():
+    global pair_count
+
+    if pair_count == 0:
+        return
+
+    pair_count -= 1
+
+    refresh_bonuses()
+
+
+# Recomputes the bonus of every pair, by its age from the newest pair (all at once, as the newest one sets the ages).
+# Made as a new array then swapped in, so a search never sees it half done
+def refresh_bonuses():
+    global pair_bonuses
+
+    if not is_enabled() or pair_count == 0:
+        return
+
+    times = pair_times[:pair_count]
+    newest_time = np.nanmax(times) if not np.all(np.isnan(times)) else 0.0
+
+    half_life_seconds = recency_half_life_days * 86400
+    recency = recency_weight * np.exp2((times - newest_time) / half_life_seconds)
+
+    pair_bonuses = np.nan_to_num(recency, nan=0.0) + (pair_pinned[:pair_count] * pinned_boost)
+
+
+# Adds the bonuses onto a set of pair scores (pair ID to score). Only pairs that actually matched (scored above 0) get
+# them, so it never drags in something that isn't relevant
+def add_bonuses(pair_scores):
+
+    if not is_enabled():
+        return pair_scores
+
+    bonuses = pair_bonuses
+
+    for pair_id in pair_scores:
+        if pair_scores[pair_id] > 0 and pair_id < len(bonuses):
+            pair_scores[pair_id] += float(bonuses[pair_id])
+
+    return pair_scores
+
+
+# Same as add_bonuses, for an array of every pair's score
+def add_bonuses_array(pair_scores):
+
+    if not is_enabled():
+        return pair_scores
+
+    bonuses = pair_bonuses
+
+    row_count = min(len(pair_scores), len(bonuses))
+    pair_scores[:row_count] += np.where(pair_scores[:row_count] > 0, bonuses[:row_count], 0)
+
+    return pair_scores
+
+
+# When a message pair is from, in seconds (NaN if it has no timestamp)
+def parse_pair_time(history):
+
+    if len(history) > 3 and isinstance(history[3], str):
+        try:
+            return float(np.datetime64(history[3].strip().replace(" ", "T"), 's').astype(np.int64))
+        except ValueError:
+            pass
+
+    return math.nan
+
+
+def is_pair_pinned(history):
+    return len(history) > 2 and isinstance(history[2], list) and pinned_tag in history[2]
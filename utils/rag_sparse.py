@@ -0,0 +1,145 @@
+import numpy as np
+
+#
+# Sparse matrix backend for the BASED RAG. Stores which words are in each message pair as a CSR (compressed sparse row)
+# term-document matrix, one for my messages and one for hers, so a whole search is just one vectorized dot product.
+# Scores are the exact same as utils.based_rag.evaluate_message, just without looping in Python. Good for huge imported logs!
+#
+
+# One matrix for each side, rows are message pairs, columns are word IDs. All entries are 1, so no data array is needed
+sparse_matrix = {
+    'me': {
+        'indptr': np.zeros(1, dtype=np.int64),
+        'indices': np.zeros(0, dtype=np.int64),
+        'lengths': np.zeros(0, dtype=np.int64),
+        'rows': 0,
+        'nnz': 0
+    },
+    'her': {
+        'indptr': np.zeros(1, dtype=np.int64),
+        'indices': np.zeros(0, dtype=np.int64),
+        'lengths': np.zeros(0, dtype=np.int64),
+        'rows': 0,
+        'nnz': 0
+    }
+}
+
+
+# Builds both matrices from scratch, from the history word ID lists
+def build_matrix(histories_word_id_database):
+
+    for side in ['me', 'her']:
+        side_histories = histories_word_id_database[side]
+
+        lengths = np.array([len(word_ids) for word_ids in side_histories], dtype=np.int64)
+        flat_ids = np.fromiter((word_id for word_ids in side_histories for word_id in word_ids), dtype=np.int64, count=int(lengths.sum()))
+        flat_rows = np.repeat(np.arange(len(side_histories), dtype=np.int64), lengths)
+
+        # Sort by row then word, dropping any repeated words within a message
+        column_count = int(flat_ids.max()) + 1 if len(flat_ids) > 0 else 1
+        unique_keys = np.unique(flat_rows * column_count + flat_ids)
+
+        indptr = np.zeros(len(side_histories) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(unique_keys // column_count, minlength=len(side_histories)), out=indptr[1:])
+
+        sparse_matrix[side] = {
+            'indptr': indptr,
+            'indices': unique_keys % column_count,
+            'lengths': lengths,
+            'rows': len(side_histories),
+            'nnz': len(unique_keys)
+        }
+
+
+# Appends a message pair as a new row (storage grows by doubling, so adds are cheap)
+def append_row(me_word_ids, her_word_ids):
+
+    for side, word_ids in [['me', me_word_ids], ['her', her_word_ids]]:
+        matrix = sparse_matrix[side]
+        new_indices = np.unique(np.asarray(word_ids, dtype=np.int64))
+
+        rows = matrix['rows']
+        nnz = matrix['nnz']
+
+        matrix['indptr'] = grow_array(matrix['indptr'], rows + 2)
+        matrix['lengths'] = grow_array(matrix['lengths'], rows + 1)
+        matrix['indices'] = grow_array(matrix['indices'], nnz + len(new_indices))
+
+        matrix['indices'][nnz:nnz + len(new_indices)] = new_indices
+        matrix['indptr'][rows + 1] = nnz + len(new_indices)
+        matrix['lengths'][rows] = len(word_ids)
+
+        matrix['rows'] = rows + 1
+        matrix['nnz'] = nnz + len(new_indices)
+
+
+# Removes the latest row (undo). The matrix gets swapped for a trimmed copy, so the next row added never writes over
+# the one a search may still be reading
+def pop_row():
+
+    for side in ['me', 'her']:
+        matrix = sparse_matrix[side]
+
+        if matrix['rows'] == 0:
+            continue
+
+        rows = matrix['rows'] - 1
+        nnz = int(matrix['indptr'][rows])
+
+        sparse_matrix[side] = {
+            'indptr': matrix['indptr'][:rows + 1].copy(),
+            'indices': matrix['indices'][:nnz].copy(),
+            'lengths': matrix['lengths'][:rows].copy(),
+            'rows': rows,
+            'nnz': nnz
+        }
+
+
+# Scores every message pair for the given keywords, returns them as an array (same math as evaluate_message on each side).
+# Only scores up to the given number of pairs, if a search wants to stick to what was there when it started
+def score_pairs(valued_word_ids, vocabulary_size, pair_count=None):
+
+    # Query vector, counting repeats just like evaluate_message does. Has a spare 0 on the end, that any word added
+    # since the search started gets clipped to (none of them are in the query anyway)
+    query = np.zeros(vocabulary_size + 1, dtype=np.int64)
+    np.add.at(query, np.asarray(valued_word_ids, dtype=np.int64), 1)
+
+    # Grab both matrices, then their rows, as a pair may be getting added or undone while we search (the arrays in a
+    # matrix only ever get bigger, and undo swaps in a new one)
+    matrices = {'me': sparse_matrix['me'], 'her': sparse_matrix['her']}
+
+    rows = min(matrices['me']['rows'], matrices['her']['rows'])
+    if pair_count is not None:
+        rows = min(rows, pair_count)
+
+    total_scores = np.zeros(rows, dtype=np.float64)
+
+    for side in ['me', 'her']:
+        matrix = matrices[side]
+        indptr = matrix['indptr'][:rows + 1]
+        nnz = int(indptr[rows])
+
+        # Sparse matrix-vector product, summed per row via the CSR row pointers
+        hit_totals = np.zeros(nnz + 1, dtype=np.int64)
+        np.cumsum(np.take(query, matrix['indices'][:nnz], mode='clip'), out=hit_totals[1:])
+        hits = hit_totals[indptr[1:]] - hit_totals[indptr[:-1]]
+
+        # Same length penalty, never less than -1
+        side_scores = hits - (matrix['lengths'][:rows] / 115)
+        np.maximum(side_scores, -1, out=side_scores)
+
+        total_scores += side_scores
+
+    return total_scores
+
+
+# Makes sure an array can hold atleast the needed amount, doubling the size when it can't
+def grow_array(array, needed_size):
+
+    if len(array) >= needed_size:
+        return array
+
+    grown_array = np.zeros(max(needed_size, len(array) * 2), dtype=array.dtype)
+    grown_array[:len(array)] = array
+
+    return grown_array
@@ -0,0 +1,178 @@
+import math
+import numpy as np
+import utils.rag_embed
+import utils.tokenizer
+
+#
+# RAG over the rolling summaries (see utils.retrospect). Only the latest two summaries get sent along normally, so this
+# recalls the older ones that are relevant to what is being said. Summaries cover a lot of history in few tokens, so
+# they give good long range recall for the context they take up.
+#
+# Has its own keyword index (BM25 over the summary words), plus vectors if we are recalling by meaning. It is not saved,
+# just rebuilt from the summary log on load, then updated as summaries get added.
+#
+
+# Settings
+summary_recall_count = 0        # How many past summaries to recall each turn, 0 turns it off
+summary_engine = "Keyword"      # "Keyword" or "Embedding", same as the RAG_ENGINE
+summary_skip_latest = 2         # The latest ones get sent along anyway, so never recall them
+
+# Tuning, same as utils.rag_bm25
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+# Keyword index; which summaries each word is in as [summary ID, term frequency], and how many words each one has
+summary_postings = {}
+summary_lengths = []
+total_summary_length = 0
+
+# Vectors, one row per summary (only if recalling by meaning)
+summary_vectors = np.zeros((0, 0), dtype=np.float16)
+
+current_summary_message = ""
+
+
+# Rebuilds the index from scratch, from the list of summaries
+def build_summary_index(summaries):
+    global summary_postings, summary_lengths, total_summary_length, summary_vectors
+
+    summary_postings = {}
+    summary_lengths = []
+    total_summary_length = 0
+    summary_vectors = np.zeros((0, 0), dtype=np.float16)
+
+    if summary_recall_count == 0:
+        return
+
+    update_summary_index(summaries)
+
+
+# Indexes any summaries that are new since last time (they only ever get added on the end). Rebuilds if it got shorter
+def update_summary_index(summaries):
+
+    if summary_recall_count == 0:
+        return
+
+    if len(summaries) < len(summary_lengths):
+        build_summary_index(summaries)
+        return
+
+    new_summaries = [str(summary) for summary in summaries[len(summary_lengths):]]
+
+    for summary in new_summaries:
+        index_summary(summary)
+
+    if summary_engine == "Embedding" and len(new_summaries) > 0:
+        add_summary_vectors(new_summaries)
+
+
+# Adds a summary to the keyword index
+def index_summary(summary):
+    global total_summary_length
+
+    summary_id = len(summary_lengths)
+    summary_words = [word for word in utils.tokenizer.split_rag_words(summary) if word != ""]
+
+    term_frequencies = {}
+    for word in summary_words:
+        term_frequencies[word] = term_frequencies.get(word, 0) + 1
+
+    for word in term_frequencies:
+        summary_postings.setdefault(word, []).append([summary_id, term_frequencies[word]])
+
+    summary_lengths.append(len(summary_words))
+    total_summary_length += len(summary_words)
+
+
+# Embeds summaries and adds their vectors on the end
+def add_summary_vectors(summaries):
+    global summary_vectors
+
+    if utils.rag_embed.embedder_name == "None":
+        utils.rag_embed.load_embedder()
+
+    new_vectors = utils.rag_embed.embed_texts(summaries)
+
+    if len(summary_vectors) == 0:
+        summary_vectors = new_vectors
+    else:
+        summary_vectors = np.concatenate([summary_vectors, new_vectors])
+
+
+# Finds the past summaries most relevant to what is being said, in the order they happened
+def find_best_summary_ids(message, her_previous):
+
+    searchable_count = len(summary_lengths) - summary_skip_latest
+
+    if searchable_count <= 0:
+        return []
+
+    if summary_engine == "Embedding" and len(summary_vectors) >= searchable_count:
+        query_vector = utils.rag_embed.embed_query(message, her_previous)
+        similarities = summary_vectors[:searchable_count].astype(np.float32) @ query_vector
+        summary_scores = dict(enumerate(similarities.tolist()))
+    else:
+        summary_scores = score_summaries(message, her_previous, searchable_count)
+
+    # Best first, the later one winning on a tie, then put back in order
+    best_summary_ids = sorted(summary_scores, key=lambda summary_id: (summary_scores[summary_id], summary_id), reverse=True)
+
+    return sorted(best_summary_ids[:summary_recall_count])
+
+
+# Scores the summaries that have any of the words being said, with BM25. Her words count for half
+def score_summaries(message, her_previous, searchable_count):
+
+    query_weights = {}
+    for word in utils.tokenizer.split_rag_words(her_previous):
+        query_weights[word] = 0.5
+    for word in utils.tokenizer.split_rag_words(message):
+        query_weights[word] = 1.0
+
+    average_length = max(total_summary_length / len(summary_lengths), 1)
+    summary_count = len(summary_lengths)
+
+    summary_scores = {}
+
+    for word in query_weights:
+        if word == "" or word not in summary_postings:
+            continue
+
+        document_frequency = len(summary_postings[word])
+        idf = math.log(1 + (summary_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+        for summary_id, term_frequency in summary_postings[word]:
+            if summary_id >= searchable_count:
+                continue
+
+            length_ratio = summary_lengths[summary_id] / average_length
+            score = idf * (term_frequency * (bm25_k1 + 1)) / (term_frequency + bm25_k1 * (1 - bm25_b + bm25_b * length_ratio))
+
+            summary_scores[summary_id] = summary_scores.get(summary_id, 0.0) + (score * query_weights[word])
+
+    return summary_scores
+
+
+# Recalls the best past summaries for this turn, ready to be sent along
+def run_summary_rag(message, her_previous, summaries):
+    global current_summary_message
+
+    current_summary_message = ""
+
+    if summary_recall_count == 0:
+        return
+
+    update_summary_index(summaries)
+
+    best_summary_ids = find_best_summary_ids(message, her_previous)
+    if len(best_summary_ids) == 0:
+        return
+
+    current_summary_message = "[System M]; These are summaries of your past memories, relevant to what is currently happening;\n"
+    for summary_id in best_summary_ids:
+        current_summary_message += str(summaries[summary_id]) + "\n\n"
+    current_summary_message += "; This is the end of the summaries!;"
+
+
+def call_summary_message():
+    return current_summary_message
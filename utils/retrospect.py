@@ -1,6 +1,7 @@
 import time
 
 import utils.based_rag
+import utils.rag_summaries
 import random
 import API.api_controller
 import utils.zw_logging
@@ -25,7 +26,8 @@ def retrospect_random_mem_summary():
     # find random point in history to think about (not including anything recently)
     search_point = random.randint(0, len(history) - 90)
 
-    history_scope = history[search_point:search_point+search_point_size]
+    # (read through the RAG, as old history may only be on disk)
+    history_scope = [utils.based_rag.get_history_pair(i) for i in range(len(history))[search_point:search_point + search_point_size]]
     retrospect_message = ("[System L] Can you please summarize all of these chat messages? These are previous memories that you, " + char_name +
                           ", have experienced. " +
                           "Feel free to focus on details that are of note or you find interest in.")
@@ -49,7 +51,7 @@ def retrospect_current_messages():
     # use a search point that is atleast 2 messages back to prevent issues
     search_point = len(history) - search_point_size - 2
 
-    history_scope = history[search_point:search_point+search_point_size]
+    history_scope = [utils.based_rag.get_history_pair(i) for i in range(len(history))[search_point:search_point + search_point_size]]
     retrospect_message = ("[System L] Can you please summarize all of these chat messages? These are previous memories that you, " + char_name +
                           ", have experienced. " +
                           "Feel free to focus on details that are of note or you find interest in. Try and note what is currently going on and what you are doing. Mention the most important things first, you have about a paragraph. " +
@@ -72,6 +74,7 @@ def retrospect_current_messages():
 
     # Save this & export to JSON
     live_summarization_log.append(API.api_controller.receive_summary_via_oogabooga())
+    utils.rag_summaries.update_summary_index(live_summarization_log)
     with open("LiveSummaryLog.json", 'w') as outfile:
         json.dump(live_summarization_log, outfile, indent=4)
 
@@ -101,6 +104,9 @@ def load_past_summaries():
     with open("LiveSummaryLog.json", 'r') as openfile:
         live_summarization_log = json.load(openfile)
 
+    # Index them, for recalling the older ones
+    utils.rag_summaries.build_summary_index(live_summarization_log)
+
     # Make a new backup of our LiveSummaryLog on each boot as well
 
     with open("Backups/LiveSummaryLogBackup.bak", 'w') as soutfile:
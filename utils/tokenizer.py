@@ -0,0 +1,153 @@
+import re
+import string
+import sys
+import unicodedata
+
+#
+# Shared tokenizer, so the RAG, the lorebook and the emotes all see words the same way. Punctuation gets stripped, it
+# all gets lowercased, and newlines count as spaces. Everything is precompiled, so splitting a message is quick.
+#
+# NOTE: Keep this module light on imports! The RAG rebuild worker processes import it on their own.
+#
+
+# Options. Changing these changes the RAG words, so manually recalculate the RAG after!
+use_stemming = False                # Cut RAG words down to their stem, so "smiling" and "smiles" both become "smil"
+use_unicode_punctuation = False     # Strip all Unicode punctuation (like “curly quotes” and ¡this!), not just ASCII
+
+# Precompiled tables and patterns
+ascii_punctuation_table = str.maketrans('', '', string.punctuation)
+unicode_punctuation_table = None        # Built on first use, as it is quite big
+space_run_pattern = re.compile(r"( +)")
+
+# Suffixes for stemming, longest first
+stem_suffixes = ["ingly", "ings", "ing", "edly", "ies", "ied", "ed", "es", "ly", "s"]
+
+
+# Sets the options (used for the RAG rebuild worker processes, which start out with the defaults)
+def set_options(stemming, unicode_punctuation):
+    global use_stemming, use_unicode_punctuation
+
+    use_stemming = stemming
+    use_unicode_punctuation = unicode_punctuation
+
+
+# Strips the punctuation, lowercases, and turns newlines into spaces
+def normalize_text(text):
+
+    if use_unicode_punctuation:
+        punctuation_table = get_unicode_punctuation_table()
+    else:
+        punctuation_table = ascii_punctuation_table
+
+    return str.lower(text.translate(punctuation_table)).replace("\n", " ")
+
+
+# Splits a message into its words, for the RAG (stemmed, if we are using that)
+def split_rag_words(text):
+    return split_words(text, use_stemming)
+
+
+# Splits a message into its words. Same split as the RAG has always done, so saved databases stay good. That means
+# runs of extra spaces give empty words (a run of 3 gives one, a run of 5 gives two, and so on)
+def split_words(text, stemming=False):
+
+    normalized_text = normalize_text(text)
+
+    # Quick way out, for the usual message with single spaces only
+    if "  " not in normalized_text and not normalized_text.startswith(" ") and not normalized_text.endswith(" "):
+        if normalized_text == "":
+            return []
+
+        words = normalized_text.split(" ")
+        if stemming:
+            words = [stem_word(word) for word in words]
+
+        return words
+
+    parts = space_run_pattern.split(normalized_text)
+
+    words = []
+    i = 0
+    while i < len(parts):
+
+        # Runs of spaces, the first one after a word is skipped over, then every other one left makes an empty word
+        if i > 0:
+            space_count = len(parts[i - 1])
+            if i > 2 or parts[0] != "":
+                space_count -= 1
+
+            if i == len(parts) - 1 and parts[i] == "":
+                words += [""] * ((space_count + 1) // 2)
+            else:
+                words += [""] * (space_count // 2)
+
+        if parts[i] != "":
+            words.append(stem_word(parts[i]) if stemming else parts[i])
+
+        i = i + 2
+
+    return words
+
+
+# Cuts a word down to its stem, by taking off a common ending (keeping atleast 3 letters)
+def stem_word(word):
+
+    for suffix in stem_suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+
+    return word
+
+
+# Checks if a phrase shows up in the words of a message, word for word. Can let the last word just be the start of one
+# (for things like "Angr" matching "angry"), or let it have an "s" on the end
+def contains_phrase(message_words, phrase, prefix_match=False, allow_plural=False):
+
+    phrase_words = [word for word in split_words(phrase) if word != ""]
+
+    if len(phrase_words) == 0:
+        return False
+
+    i = 0
+    while i + len(phrase_words) <= len(message_words):
+
+        if message_words[i:i + len(phrase_words) - 1] == phrase_words[:-1]:
+            last_word = message_words[i + len(phrase_words) - 1]
+
+            if last_word == phrase_words[-1]:
+                return True
+            if prefix_match and last_word.startswith(phrase_words[-1]):
+                return True
+            if allow_plural and last_word == phrase_words[-1] + "s":
+                return True
+
+        i = i + 1
+
+    return False
+
+
+# Checks if any keyword shows up in the words of a message. A keyword ending in a space has to be the whole word,
+# otherwise it can be the start of one
+def keyword_match(message_words, keywords):
+
+    for keyword in keywords:
+        if contains_phrase(message_words, keyword, prefix_match=not keyword.endswith(" ")):
+            return True
+
+    return False
+
+
+# Makes the table for stripping all Unicode punctuation (plus the ASCII symbols, same as the normal table)
+def get_unicode_punctuation_table():
+    global unicode_punctuation_table
+
+    if unicode_punctuation_table is None:
+        punctuation_table = dict(ascii_punctuation_table)
+
+        for codepoint in range(sys.maxunicode + 1):
+            if unicodedata.category(chr(codepoint)).startswith("P"):
+                punctuation_table[codepoint] = None
+
+        unicode_punctuation_table = punctuation_table
+
+    return unicode_punctuation_table
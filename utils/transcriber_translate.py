@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import utils.cane_lib
+import utils.based_rag
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -117,6 +118,9 @@ def chunky_transcribe(voice_clip):
     else:
         transcription_chunks.append(str(classical_transcribe(voice_clip)))
 
+    # Start looking for memories with what we have so far, so the RAG is ready by the time we are done talking
+    utils.based_rag.start_speculative_rag("".join(transcription_chunks))
+
 
 # Runs thread/loop for chunky transcript requests
 def chunky_transcription_loop():
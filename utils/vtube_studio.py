@@ -1,6 +1,7 @@
 import time
 
-import utils.cane_lib
+import utils.tokenizer
+import utils.zw_logging
 import asyncio,os,threading
 import pyvts
 import json
@@ -69,20 +70,13 @@ def check_emote_string():
 
     # Cleanup the text to only look at the asterisk'ed words
 
-    clean_emote_text = ''
-    asterisk_count = 0
-
-    for char in EMOTE_STRING:
-        if char == "*":
-            asterisk_count += 1
-        elif asterisk_count % 2 == 1:
-            clean_emote_text = clean_emote_text + char
+    clean_emote_words = get_emote_words()
 
 
     # Run through emotes, using OOP to only run one at a time (last = most prominent)
 
     for emote_page in emote_lib:
-        if utils.cane_lib.keyword_check(clean_emote_text, emote_page[0]) and not emote_list.__contains__(emote_page[1]):
+        if check_emote_keywords(clean_emote_words, emote_page[0]) and not emote_list.__contains__(emote_page[1]):
             EMOTE_ID = emote_page[1]
             emote_list.append(emote_page[1])
 
@@ -98,18 +92,11 @@ def check_emote_string_streaming():
     emote_list = []
 
     # Cleanup the text to only look at the asterisk'ed words
-    clean_emote_text = ''
-    asterisk_count = 0
-
-    for char in EMOTE_STRING:
-        if char == "*":
-            asterisk_count += 1
-        elif asterisk_count % 2 == 1:
-            clean_emote_text = clean_emote_text + char
+    clean_emote_words = get_emote_words()
 
     # Check if there is an emote that we DON'T have in the streaming one!
     for emote_page in emote_lib:
-        if utils.cane_lib.keyword_check(clean_emote_text, emote_page[0]) and not streaming_emote_list.__contains__(emote_page[1]):
+        if check_emote_keywords(clean_emote_words, emote_page[0]) and not streaming_emote_list.__contains__(emote_page[1]):
             emote_list.append(emote_page[1])
             streaming_emote_list.append(emote_page[1])
 
@@ -119,6 +106,43 @@ def check_emote_string_streaming():
             emote_request_list.append(inlist_emote)
 
 
+# Gets the words inside the asterisks. Each *group* gets a space after it, so "*grins* *blushes*" doesn't become one word
+def get_emote_words():
+
+    clean_emote_text = ''
+    asterisk_count = 0
+
+    for char in EMOTE_STRING:
+        if char == "*":
+            asterisk_count += 1
+            if asterisk_count % 2 == 0:
+                clean_emote_text = clean_emote_text + " "
+        elif asterisk_count % 2 == 1:
+            clean_emote_text = clean_emote_text + char
+
+    return utils.tokenizer.split_words(clean_emote_text)
+
+
+# Checks the emote keywords against the starts of the words. Anything the old substring check would've found at the
+# start of a word has to fire here too, so log it if that ever doesn't happen
+def check_emote_keywords(clean_emote_words, keywords):
+
+    if utils.tokenizer.keyword_match(clean_emote_words, keywords):
+        return True
+
+    for keyword in keywords:
+        if keyword.endswith(" "):
+            continue
+
+        keyword_word = str.lower(keyword)
+        for word in clean_emote_words:
+            if word.startswith(keyword_word):
+                utils.zw_logging.update_debug_log("Emote keyword \"" + keyword + "\" was in \"" + word + "\" but didn't fire!")
+                return True
+
+    return False
+
+
 def clear_streaming_emote_list():
     global streaming_emote_list
     streaming_emote_list = []
@@ -135,13 +135,22 @@ with gr.Blocks(theme=based_theme, title="Z-Waif UI") as demo:
                 main.main_undo()
                 return
 
+            def pin_memory():
+                if API.api_controller.toggle_pin_latest():
+                    print("\nPinned the latest message as a memory!\n")
+                else:
+                    print("\nUnpinned the latest message!\n")
+                return
+
             button_regen = gr.Button(value="Reroll")
             button_blank = gr.Button(value="Send Blank")
             button_undo = gr.Button(value="Undo")
+            button_pin = gr.Button(value="Pin / Unpin Memory")
 
             button_regen.click(fn=regenerate)
             button_blank.click(fn=send_blank)
             button_undo.click(fn=undo)
+            button_pin.click(fn=pin_memory)
 
 
         #